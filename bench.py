@@ -0,0 +1,197 @@
+"""Бенчмарк MeshBridge: задержки event loop и доставки в одно- и двухпроцессном режиме.
+
+Пакеты проходят через настоящий конвейер bot.py (pubsub → очередь → process_packet),
+Telegram заменён получателем без сети, файлы пишутся во временный каталог.
+
+    python bench.py 20000
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from meshtastic.protobuf import mesh_pb2, portnums_pb2
+from google.protobuf.json_format import MessageToDict
+from pubsub import pub
+
+import bot
+
+PROCESS_PACKET = bot.process_packet
+
+
+def raw_packets(count):
+    packets = []
+    for i in range(count):
+        packet = mesh_pb2.MeshPacket()
+        setattr(packet, "from", 0x10000000 + i % 200)
+        packet.to = 0xFFFFFFFF
+        packet.id = i + 1
+        packet.rx_snr = 5.5
+        packet.hop_limit = 2
+        packet.hop_start = 3
+        if i % 100 == 0:
+            # изредка nodeinfo со сменой имени — чтобы работало сохранение кэша имён
+            packet.decoded.portnum = portnums_pb2.PortNum.NODEINFO_APP
+            packet.decoded.payload = mesh_pb2.User(short_name=f"B{i % 1000}").SerializeToString()
+        else:
+            packet.decoded.portnum = portnums_pb2.PortNum.TEXT_MESSAGE_APP
+            packet.decoded.payload = f"[TG: bench] сообщение номер {i} ".encode("utf-8") * 3
+        packets.append(packet.SerializeToString())
+    return packets
+
+
+def decode(raw):
+    """Та же работа, что делает поток чтения meshtastic: protobuf → dict, выбор топика"""
+    packet = mesh_pb2.MeshPacket()
+    packet.ParseFromString(raw)
+    as_dict = MessageToDict(packet)
+    if packet.decoded.portnum == portnums_pb2.PortNum.NODEINFO_APP:
+        as_dict["decoded"]["user"] = MessageToDict(mesh_pb2.User.FromString(packet.decoded.payload))
+        topic = "meshtastic.receive.user"
+    else:
+        as_dict["decoded"]["text"] = packet.decoded.payload.decode("utf-8")
+        topic = "meshtastic.receive.text"
+    as_dict["raw"] = packet
+    return topic, as_dict
+
+
+def read_packet(raw):
+    """Момент чтения пакета из порта — от него считается задержка в обоих режимах"""
+    ts = time.monotonic()
+    topic, packet = decode(raw)
+    packet["benchTs"] = ts
+    return topic, packet
+
+
+def radio_side(conn, packets):
+    for raw in packets:
+        topic, packet = read_packet(raw)
+        conn.sendall(bot.encode_frame(bot.FRAME_PACKET, {"t": topic, "p": bot._strip_packet(packet)}))
+    conn.close()
+
+
+class Telegram:
+    """Получатель сообщений без сети: бенчмарк меряет бота, а не Telegram API"""
+
+    async def send_message(self, chat_id, text):
+        return SimpleNamespace(chat_id=chat_id, message_id=0)
+
+
+def setup(workdir, latencies):
+    bot.MAIN_LOOP = asyncio.get_running_loop()
+    bot.INBOUND_QUEUE = asyncio.Queue(maxsize=bot.INBOUND_QUEUE_SIZE)
+    bot.application = SimpleNamespace(bot=Telegram())
+    bot.ROUTING_TABLE = bot.build_routing_table([{"channel": 0, "chat_id": -1}])
+    bot.NODE_NAME_FILE = os.path.join(workdir, "node_names.json")
+    if bot.MESSAGE_ARCHIVE_CONN is None:
+        bot.MESSAGE_ARCHIVE_DB = os.path.join(workdir, "messages.db")
+        bot.init_message_archive()
+    bot.NODE_NAME_CACHE.clear()
+    bot.RECENT_PACKET_IDS.clear()
+    bot.MESSAGE_ARCHIVE_BUFFER.clear()
+    for key in bot.PIPELINE_STATS:
+        bot.PIPELINE_STATS[key] = 0
+
+    def measured(topic, packet, interface, outgoing):
+        PROCESS_PACKET(topic, packet, interface, outgoing)
+        latencies.append(time.monotonic() - packet["benchTs"])
+
+    bot.process_packet = measured
+    bot.subscribe_meshtastic()
+    return asyncio.create_task(bot.inbound_pipeline_task())
+
+
+async def wait_processed(total):
+    stats = bot.PIPELINE_STATS
+    while stats["processed"] + stats["dropped"] + stats["errors"] < total:
+        await asyncio.sleep(0.01)
+
+
+async def measure_lag(done, lags):
+    interval = 0.005
+    while not done.is_set():
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lags.append(time.monotonic() - started - interval)
+
+
+async def run_single(packets, workdir):
+    done = asyncio.Event()
+    lags, latencies = [], []
+    pipeline = setup(workdir, latencies)
+    iface = SimpleNamespace(myInfo=SimpleNamespace(my_node_num=1), nodes={})
+
+    def reader_thread():
+        for raw in packets:
+            topic, packet = read_packet(raw)
+            pub.sendMessage(topic, packet=packet, interface=iface)
+
+    lag_task = asyncio.create_task(measure_lag(done, lags))
+    started = time.monotonic()
+    threading.Thread(target=reader_thread, daemon=True).start()
+    await wait_processed(len(packets))
+    elapsed = time.monotonic() - started
+    done.set()
+    await lag_task
+    pipeline.cancel()
+    return elapsed, lags, latencies
+
+
+async def run_split(packets, workdir):
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    worker = multiprocessing.get_context("fork").Process(target=radio_side, args=(child_sock, packets))
+    done = asyncio.Event()
+    lags, latencies = [], []
+    pipeline = setup(workdir, latencies)
+
+    lag_task = asyncio.create_task(measure_lag(done, lags))
+    started = time.monotonic()
+    worker.start()
+    child_sock.close()
+    reader, writer = await asyncio.open_unix_connection(sock=parent_sock)
+    remote = bot.RemoteInterface(writer)
+    remote.myInfo = SimpleNamespace(my_node_num=1)
+    # так же, как radio_link_task: кадр → pubsub → конвейер
+    for _ in packets:
+        frame_type, payload = await bot.read_frame(reader)
+        pub.sendMessage(payload["t"], packet=payload["p"], interface=remote)
+    await wait_processed(len(packets))
+    elapsed = time.monotonic() - started
+    done.set()
+    await lag_task
+    pipeline.cancel()
+    writer.close()
+    worker.join()
+    return elapsed, lags, latencies
+
+
+def main(count=20000):
+    packets = raw_packets(count)
+    workdir = tempfile.mkdtemp(prefix="meshbridge-bench-")
+    # логи обработчиков пишутся, как в работе, но не в meshbridge.log
+    logging.getLogger().handlers = [logging.FileHandler(os.path.join(workdir, "bench.log"))]
+    results = []
+    for mode, runner in (("single", run_single), ("split", run_split)):
+        results.append((mode, asyncio.run(runner(packets, workdir)), dict(bot.PIPELINE_STATS)))
+
+    print(f"Бенчмарк: {count} пакетов одним всплеском (каждый сотый — nodeinfo), рабочий каталог {workdir}")
+    print(f"{'режим':<8} {'пакет/с':>9} {'lag p50':>9} {'lag p99':>9} {'lag max':>9} "
+          f"{'доставка p50':>13} {'доставка p99':>13} {'отброшено':>10}")
+    for mode, (elapsed, lags, latencies), stats in results:
+        print(
+            f"{mode:<8} {count / elapsed:>9.0f} "
+            f"{bot.percentile(lags, 50) * 1000:>7.2f}мс {bot.percentile(lags, 99) * 1000:>7.2f}мс "
+            f"{max(lags or [0]) * 1000:>7.2f}мс "
+            f"{bot.percentile(latencies, 50) * 1000:>11.2f}мс {bot.percentile(latencies, 99) * 1000:>11.2f}мс "
+            f"{stats['dropped']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -5,6 +5,21 @@ import time
 import nest_asyncio
 import json
 import datetime
+import re
+import math
+import threading
+import socket
+import struct
+import subprocess
+import signal
+import sys
+import heapq
+import io
+import functools
+import sqlite3
+import tracemalloc
+from collections import deque, OrderedDict
+from types import SimpleNamespace
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from meshtastic.serial_interface import SerialInterface
@@ -26,23 +41,145 @@ logging.getLogger("meshtastic").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext").setLevel(logging.INFO)
 
+def memory_cap(name, default):
+    """Лимит размера структуры: MEMORY_MAX_<NAME> или общий по умолчанию"""
+    return int(os.getenv(f"MEMORY_MAX_{name.upper()}", default))
+
+class LRUDict(OrderedDict):
+    """Словарь с ограничением размера. Запись делает ключ самым свежим,
+    при переполнении вытесняется самый давно обновлявшийся ключ; вытесненное
+    уходит в архив на диск (node_archive.jsonl)."""
+
+    def __init__(self, name, maxsize, on_evict=None, archive=True):
+        super().__init__()
+        self.name = name
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.archive = archive
+        self.evicted = 0
+        MEMORY_STRUCTURES[name] = self
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.move_to_end(key)
+        super().__setitem__(key, value)
+        if self.maxsize and len(self) > self.maxsize:
+            key, value = self.popitem(last=False)
+            self.evicted += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+            if self.archive:
+                NODE_ARCHIVE_BUFFER.append({"ts": int(time.time()), "structure": self.name, "node": key, "value": value})
+
+    def touch(self, key):
+        if key in self:
+            self.move_to_end(key)
+
+MEMORY_STRUCTURES = {}
+MEMORY_MAX_NODES = int(os.getenv("MEMORY_MAX_NODES", "3000"))
+NODE_ARCHIVE_FILE = "node_archive.jsonl"
+NODE_ARCHIVE_BUFFER = deque(maxlen=10000)
+
 interface = None
 application = None
-CHANNEL_TO_CHAT = {}
+ROUTES_FILE = "routes.json"
+ROUTING_TABLE = {"forward": {}, "reverse": {}, "routes": ()}
+ROUTES_MTIME = None
+LEGACY_ROUTES = None
+ROUTE_DIRECTIONS = ("both", "mesh_to_tg", "tg_to_mesh")
+MESH_TEXT_MAX = 80
+TG_QUOTA_USER_BYTES = int(os.getenv("TG_QUOTA_USER_BYTES", "600"))
+TG_QUOTA_CHAT_BYTES = int(os.getenv("TG_QUOTA_CHAT_BYTES", "1500"))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "3"))
+QUOTA_BUCKETS = {}
+QUOTA_NOTIFIED = LRUDict("quota_notified", memory_cap("quota_notified", 1000), archive=False)
+COALESCE_BUFFERS = {}
+MESH_SEND_LOCKS = {}
+ACK_TIMEOUT = 30
+ACK_BACKOFF = 10
+ACK_MAX_RETRIES = 2
+ACK_MAX_PENDING = 256
+ACK_RETRYABLE = {"NO_ROUTE", "GOT_NAK", "TIMEOUT", "NO_INTERFACE", "MAX_RETRANSMIT",
+                 "DUTY_CYCLE_LIMIT", "RATE_LIMIT_EXCEEDED"}
+# для широковещательных это не ошибка: пакет ушёл в эфир, прошивка лишь не услышала ретрансляцию
+ACK_BROADCAST_UNCONFIRMED = {"MAX_RETRANSMIT", "TIMEOUT"}
+PENDING_ACKS = OrderedDict()
+MULTIPART_RE = re.compile(r"^(.*) \((\d+)/(\d+)\)$", re.S)
+MULTIPART_TIMEOUT = float(os.getenv("MULTIPART_TIMEOUT", "30"))
+MULTIPART_EDIT_WINDOW = 300
+MULTIPART_MAX_PARTS = 20
+MULTIPART_BUFFERS = {}
 MAIN_LOOP = None
 ADMIN_USER_ID = None
-NODE_NAME_CACHE = {}
+NODE_NAME_CACHE = LRUDict("node_names", memory_cap("node_names", MEMORY_MAX_NODES))
 NODE_NAME_FILE = "node_names.json"
 FAVORITES_FILE = "favorites.json"
 START_TIME = time.time()
-MESSAGE_STATS = {"mesh_to_tg": 0, "tg_to_mesh": 0}
-NODE_MESSAGE_COUNT = {}
-NODE_MESSAGE_HISTORY = {}
+MESSAGE_STATS = {"mesh_to_tg": 0, "tg_to_mesh": 0, "tg_coalesced": 0, "tg_over_quota": 0,
+                 "mesh_acked": 0, "mesh_failed": 0, "mesh_retries": 0,
+                 "mesh_parts": 0, "mesh_reassembled": 0}
+NODE_MESSAGE_COUNT = LRUDict("message_count", memory_cap("message_count", MEMORY_MAX_NODES))
+NODE_MESSAGE_HISTORY = LRUDict("message_history", memory_cap("message_history", MEMORY_MAX_NODES))
 MAX_HISTORY_DAYS = 7
-SEEN_NODES = set()
-BATTERY_VOLTAGE_HISTORY = {}
+# суффикс → время последнего появления; лимит больше, чтобы вернувшиеся ноды не считались новыми
+SEEN_NODES = LRUDict("seen_nodes", memory_cap("seen_nodes", MEMORY_MAX_NODES * 5), archive=False)
+RECENT_PACKET_IDS = LRUDict("recent_packets", memory_cap("recent_packets", 2000), archive=False)
+BATTERY_VOLTAGE_HISTORY = LRUDict("battery_voltage", memory_cap("battery_voltage", MEMORY_MAX_NODES))
 BATTERY_LOW_NOTIFIED = set()
 BATTERY_LOW_THRESHOLD = 3.5
+NODE_POSITIONS = LRUDict("positions", memory_cap("positions", MEMORY_MAX_NODES), on_evict=lambda k, v: _unindex_position(k, v))
+POSITION_GRID = {}
+POSITION_GRID_DEG = 0.1
+POSITION_LOCK = threading.Lock()
+EARTH_RADIUS_KM = 6371.0
+MESH_GRAPH = LRUDict("mesh_graph", memory_cap("mesh_graph", MEMORY_MAX_NODES), on_evict=lambda k, v: _drop_graph_node(k, v))
+NODE_HOPS = LRUDict("node_hops", memory_cap("node_hops", MEMORY_MAX_NODES), archive=False)
+TOPOLOGY_LOCK = threading.Lock()
+TOPOLOGY_SNR_ALPHA = 0.3
+TOPOLOGY_DECAY = 1800
+TOPOLOGY_EDGE_TTL = 6 * 3600
+DIRECT_NEIGHBOR_TTL = 3600
+TRACEROUTE_UNKNOWN_SNR = -128
+BRIDGE_MODE = os.getenv("BRIDGE_MODE", "single").lower()
+BRIDGE_SOCKET = os.getenv("BRIDGE_SOCKET", "/tmp/meshbridge.sock")
+BRIDGE_ROLE = "single"
+MESH_DEVICE = "/dev/ttyACM0"
+FRAME_HEADER = struct.Struct("!IB")
+FRAME_MAX_SIZE = 4 * 1024 * 1024
+FRAME_PACKET = 1
+FRAME_NODES = 2
+FRAME_CALL = 3
+FRAME_RESULT = 4
+NODES_SNAPSHOT_INTERVAL = 30
+RADIO_CONN = None
+RADIO_SEND_LOCK = threading.Lock()
+RADIO_BACKLOG = deque(maxlen=500)
+REMOTE_CALL_ID = 0
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_DEPTH = 64
+PROFILE_MAX_STACKS = 50000
+PROFILER = {"thread": None, "stop": None, "samples": {}, "ticks": 0, "started": None}
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_BASELINE = None
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_SAMPLES = deque(maxlen=600)
+LOOP_LAG_MAX = 0.0
+HANDLER_TIMINGS = {}
+INBOUND_QUEUE_SIZE = int(os.getenv("INBOUND_QUEUE_SIZE", "2000"))
+INBOUND_QUEUE = None
+INBOUND_BATCH_MAX = 64
+TELEGRAM_TEXT_MAX = 4096
+PIPELINE_STATS = {"received": 0, "dropped": 0, "duplicates": 0, "processed": 0, "errors": 0,
+                  "batches": 0, "max_batch": 0, "max_depth": 0, "tg_merged": 0}
+PIPELINE_WAIT = deque(maxlen=1000)
+NAME_SAVE_DELAY = 5
+NAME_SAVE_HANDLE = None
+MESSAGE_ARCHIVE_DB = "messages.db"
+MESSAGE_ARCHIVE_CONN = None
+MESSAGE_ARCHIVE_LOCK = threading.Lock()
+MESSAGE_ARCHIVE_BUFFER = deque(maxlen=50000)
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "90"))
+ARCHIVE_FLUSH_INTERVAL = 5
 
 def get_node_suffix(node_id):
     if isinstance(node_id, str) and node_id.startswith('!'):
@@ -71,27 +208,32 @@ def save_favorites(favorites):
         logger.error(f"Ошибка сохранения {FAVORITES_FILE}: {e}")
 
 def load_node_name_cache():
-    global NODE_NAME_CACHE, SEEN_NODES
+    NODE_NAME_CACHE.clear()
+    SEEN_NODES.clear()
     try:
         with open(NODE_NAME_FILE, "r", encoding="utf-8") as f:
-            NODE_NAME_CACHE = json.load(f)
-        SEEN_NODES = set(NODE_NAME_CACHE.keys())
+            NODE_NAME_CACHE.update(json.load(f))
+        now = time.time()
+        for suffix in NODE_NAME_CACHE:
+            SEEN_NODES[suffix] = now
         logger.info(f"📂 Кэш имён загружен из файла ({len(NODE_NAME_CACHE)} нод)")
     except Exception as e:
         logger.warning(f"⚠️ Не удалось загрузить кэш имён: {e}")
-        NODE_NAME_CACHE = {}
-        SEEN_NODES = set()
 
 def save_node_name_cache():
     try:
-        with open(NODE_NAME_FILE, "w", encoding="utf-8") as f:
-            json.dump(NODE_NAME_CACHE, f, ensure_ascii=False, indent=2)
+        # снимок словаря: LRU-порядок меняется при каждом пакете, а json.dump итерирует долго;
+        # запись через временный файл, чтобы сбой не оставил обрезанный node_names.json
+        snapshot = dict(NODE_NAME_CACHE)
+        tmp_file = NODE_NAME_FILE + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, NODE_NAME_FILE)
         logger.info(f"💾 Кэш имён сохранён в файл ({len(NODE_NAME_CACHE)} нод)")
     except Exception as e:
         logger.warning(f"⚠️ Не удалось сохранить кэш имён: {e}")
 
 def update_node_name_cache():
-    global NODE_NAME_CACHE
     updated = 0
     added = 0
     if not interface or not hasattr(interface, 'nodes'):
@@ -120,6 +262,418 @@ def update_node_name_cache():
     save_node_name_cache()
     return {"total": total, "added": added, "updated": updated}
 
+def build_routing_table(entries):
+    """Прямая (канал → маршруты) и обратная (чат → маршруты) карты для поиска за O(1)"""
+    forward = {}
+    reverse = {}
+    routes = []
+    for entry in entries:
+        direction = entry.get("direction", "both")
+        if direction not in ROUTE_DIRECTIONS:
+            raise ValueError(f"Неизвестное направление маршрута: {direction}")
+        include = entry.get("include")
+        exclude = entry.get("exclude")
+        nodes = entry.get("nodes")
+        route = {
+            "channel": int(entry["channel"]),
+            "chat_id": int(entry["chat_id"]),
+            "direction": direction,
+            "include": re.compile(include, re.IGNORECASE) if include else None,
+            "exclude": re.compile(exclude, re.IGNORECASE) if exclude else None,
+            "nodes": frozenset(n.upper() for n in nodes) if nodes else None,
+        }
+        routes.append(route)
+        if direction in ("both", "mesh_to_tg"):
+            forward.setdefault(route["channel"], []).append(route)
+        if direction in ("both", "tg_to_mesh"):
+            reverse.setdefault(route["chat_id"], []).append(route)
+    return {
+        "forward": {k: tuple(v) for k, v in forward.items()},
+        "reverse": {k: tuple(v) for k, v in reverse.items()},
+        "routes": tuple(routes),
+    }
+
+def route_allows(route, text, sender_suffix=None):
+    if route["nodes"] is not None and sender_suffix is not None and sender_suffix not in route["nodes"]:
+        return False
+    if route["include"] is not None and not route["include"].search(text):
+        return False
+    if route["exclude"] is not None and route["exclude"].search(text):
+        return False
+    return True
+
+def load_routing_table():
+    """Загрузка маршрутов из routes.json (или из переменных .env); при ошибке остаётся прежняя таблица"""
+    global ROUTING_TABLE, ROUTES_MTIME
+    try:
+        mtime = os.path.getmtime(ROUTES_FILE)
+    except OSError:
+        mtime = None
+
+    try:
+        if mtime is not None:
+            with open(ROUTES_FILE, "r", encoding="utf-8") as f:
+                table = build_routing_table(json.load(f))
+            source = ROUTES_FILE
+        elif LEGACY_ROUTES:
+            table = build_routing_table(LEGACY_ROUTES)
+            source = ".env"
+        else:
+            logger.warning(f"⚠️ Нет {ROUTES_FILE} и каналов в .env")
+            return False
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки маршрутов: {e}")
+        ROUTES_MTIME = mtime
+        return False
+
+    # Замена одной ссылкой: обработчики видят либо старую, либо новую таблицу целиком
+    ROUTING_TABLE = table
+    ROUTES_MTIME = mtime
+    logger.info(f"✅ Загружено маршрутов: {len(table['routes'])} (из {source})")
+    return True
+
+def get_my_suffix():
+    if interface and hasattr(interface, 'myInfo') and interface.myInfo:
+        return get_node_suffix(interface.myInfo.my_node_num)
+    return None
+
+def find_node_suffix(target):
+    """Поиск суффикса ноды по имени (с учётом регистра) или по суффиксу"""
+    for suffix, name in list(NODE_NAME_CACHE.items()):
+        if name == target or suffix == target.upper():
+            return suffix
+    return None
+
+def extract_position(position):
+    if not position:
+        return None
+    lat = position.get('latitude')
+    lon = position.get('longitude')
+    if lat is None and 'latitudeI' in position:
+        lat = position['latitudeI'] * 1e-7
+    if lon is None and 'longitudeI' in position:
+        lon = position['longitudeI'] * 1e-7
+    if lat is None or lon is None:
+        return None
+    # 0,0 — нода без GPS-фикса
+    if lat == 0 and lon == 0:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+def position_cell(lat, lon):
+    return (math.floor(lat / POSITION_GRID_DEG), math.floor(lon / POSITION_GRID_DEG))
+
+def _unindex_position(suffix, position):
+    # вызывается и при вытеснении из NODE_POSITIONS — POSITION_LOCK уже захвачен
+    bucket = POSITION_GRID.get(position[3])
+    if bucket is not None:
+        bucket.discard(suffix)
+        if not bucket:
+            del POSITION_GRID[position[3]]
+
+def update_node_position(suffix, lat, lon, ts=None):
+    """Инкрементальное обновление позиции ноды в сеточном индексе"""
+    cell = position_cell(lat, lon)
+    with POSITION_LOCK:
+        old = NODE_POSITIONS.get(suffix)
+        if old is not None and old[0] == lat and old[1] == lon:
+            if ts and ts > old[2]:
+                NODE_POSITIONS[suffix] = (lat, lon, ts, cell)
+            return False
+        if old is not None and old[3] != cell:
+            _unindex_position(suffix, old)
+        NODE_POSITIONS[suffix] = (lat, lon, ts or time.time(), cell)
+        POSITION_GRID.setdefault(cell, set()).add(suffix)
+    return True
+
+def update_node_positions():
+    """Загрузка позиций из базы нод Meshtastic"""
+    if not interface or not hasattr(interface, 'nodes'):
+        return 0
+    updated = 0
+    for node_id, node in list(interface.nodes.items()):
+        suffix = get_node_suffix(node_id)
+        position = node.get('position')
+        coords = extract_position(position)
+        if suffix is None or coords is None:
+            continue
+        ts = position.get('time') or node.get('lastHeard')
+        if update_node_position(suffix, coords[0], coords[1], ts):
+            updated += 1
+    if updated:
+        logger.info(f"📍 Позиции из базы нод обновлены: {updated}, всего {len(NODE_POSITIONS)}")
+    return updated
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def node_distance_km(suffix_a, suffix_b):
+    pos_a = NODE_POSITIONS.get(suffix_a) if suffix_a else None
+    pos_b = NODE_POSITIONS.get(suffix_b) if suffix_b else None
+    if pos_a is None or pos_b is None:
+        return None
+    return haversine_km(pos_a[0], pos_a[1], pos_b[0], pos_b[1])
+
+def _drop_graph_node(node, neighbors):
+    # вызывается при вытеснении из MESH_GRAPH — TOPOLOGY_LOCK уже захвачен
+    for neighbor in neighbors:
+        adjacency = MESH_GRAPH.get(neighbor)
+        if adjacency is not None:
+            adjacency.pop(node, None)
+
+def update_mesh_edge(node_a, node_b, snr=None, ts=None):
+    """Обновление ребра графа: SNR сглаживается EWMA, время — последний контакт"""
+    if not node_a or not node_b or node_a == node_b:
+        return
+    ts = ts or time.time()
+    with TOPOLOGY_LOCK:
+        MESH_GRAPH.touch(node_a)
+        MESH_GRAPH.touch(node_b)
+        edge = MESH_GRAPH.get(node_a, {}).get(node_b)
+        if edge is None:
+            # Одно ребро на пару: обе записи смежности ссылаются на один список [snr, last_seen]
+            edge = [snr, ts]
+            for node, neighbor in ((node_a, node_b), (node_b, node_a)):
+                if node not in MESH_GRAPH:
+                    MESH_GRAPH[node] = {}
+                MESH_GRAPH[node][neighbor] = edge
+            return
+        if ts < edge[1]:
+            return
+        if snr is not None:
+            edge[0] = snr if edge[0] is None else edge[0] + TOPOLOGY_SNR_ALPHA * (snr - edge[0])
+        edge[1] = ts
+
+def update_node_hops(suffix, hops, ts):
+    current = NODE_HOPS.get(suffix)
+    if current is None or ts >= current[1]:
+        NODE_HOPS[suffix] = (hops, ts)
+
+def _traceroute_chain(chain, snrs, ts):
+    for i in range(len(chain) - 1):
+        snr = snrs[i] if i < len(snrs) else None
+        if snr is not None:
+            snr = None if snr == TRACEROUTE_UNKNOWN_SNR else snr / 4
+        update_mesh_edge(chain[i], chain[i + 1], snr, ts)
+
+def ingest_topology(packet):
+    from_id = packet.get('from')
+    if from_id is None:
+        return
+    sender = f"{from_id & 0xFFFFFF:06X}"
+    my_suffix = get_my_suffix()
+    ts = packet.get('rxTime') or time.time()
+
+    hop_start = packet.get('hopStart')
+    if hop_start:
+        hops = hop_start - packet.get('hopLimit', 0)
+        if hops >= 0:
+            update_node_hops(sender, hops, ts)
+            if hops == 0 and my_suffix and sender != my_suffix:
+                update_mesh_edge(my_suffix, sender, packet.get('rxSnr'), ts)
+
+    decoded = packet.get('decoded', {})
+    neighbor_info = decoded.get('neighborinfo')
+    if neighbor_info:
+        origin = get_node_suffix(neighbor_info.get('nodeId', from_id))
+        for neighbor in neighbor_info.get('neighbors', []):
+            if 'nodeId' in neighbor:
+                update_mesh_edge(origin, get_node_suffix(neighbor['nodeId']), neighbor.get('snr'), ts)
+
+    traceroute = decoded.get('traceroute')
+    if traceroute is not None:
+        to_suffix = get_node_suffix(packet.get('to', 0))
+        route = [get_node_suffix(n) for n in traceroute.get('route', [])]
+        back = [get_node_suffix(n) for n in traceroute.get('routeBack', [])]
+        if decoded.get('requestId'):
+            # Ответ: route — путь от запросившего (to) к ответившему (from), routeBack — обратно
+            _traceroute_chain([to_suffix] + route + [sender], traceroute.get('snrTowards', []), ts)
+            if 'snrBack' in traceroute:
+                _traceroute_chain([sender] + back + [to_suffix], traceroute['snrBack'], ts)
+        else:
+            _traceroute_chain([sender] + route + [to_suffix], traceroute.get('snrTowards', []), ts)
+
+def update_topology_from_nodedb():
+    if not interface or not hasattr(interface, 'nodes'):
+        return
+    my_suffix = get_my_suffix()
+    for node_id, node in list(interface.nodes.items()):
+        suffix = get_node_suffix(node_id)
+        hops = node.get('hopsAway')
+        last_heard = node.get('lastHeard')
+        if suffix is None or suffix == my_suffix or hops is None or not last_heard:
+            continue
+        update_node_hops(suffix, hops, last_heard)
+        if hops == 0 and my_suffix:
+            update_mesh_edge(my_suffix, suffix, node.get('snr'), last_heard)
+
+def sync_node_db():
+    """Инкрементальная синхронизация позиций и топологии с базой нод"""
+    update_node_positions()
+    update_topology_from_nodedb()
+
+def prune_topology(now=None):
+    now = now or time.time()
+    removed = 0
+    with TOPOLOGY_LOCK:
+        for node, neighbors in list(MESH_GRAPH.items()):
+            for neighbor, edge in list(neighbors.items()):
+                if now - edge[1] > TOPOLOGY_EDGE_TTL:
+                    del neighbors[neighbor]
+                    removed += 1
+            if not neighbors:
+                del MESH_GRAPH[node]
+    for suffix, (hops, ts) in list(NODE_HOPS.items()):
+        if now - ts > TOPOLOGY_EDGE_TTL:
+            NODE_HOPS.pop(suffix, None)
+    # каждое ребро хранится в двух записях смежности
+    return removed // 2
+
+def edge_cost(edge, now):
+    """Стоимость ребра: 1 за хоп плюс штраф за слабый SNR, делённая на свежесть"""
+    snr = edge[0] if edge[0] is not None else -5.0
+    freshness = math.exp(-max(0.0, now - edge[1]) / TOPOLOGY_DECAY)
+    return (1.0 + max(0.0, (10.0 - snr) / 10.0)) / max(freshness, 0.05)
+
+def direct_neighbors(now=None):
+    now = now or time.time()
+    my_suffix = get_my_suffix()
+    with TOPOLOGY_LOCK:
+        neighbors = [(n, e[0], e[1]) for n, e in MESH_GRAPH.get(my_suffix, {}).items()
+                     if now - e[1] <= DIRECT_NEIGHBOR_TTL]
+    neighbors.sort(key=lambda x: x[1] if x[1] is not None else -99.0, reverse=True)
+    return neighbors
+
+def best_route(target, now=None):
+    """Лучший путь от нашей ноды до target по графу (Дейкстра), список суффиксов или None"""
+    now = now or time.time()
+    source = get_my_suffix()
+    if not source or not target:
+        return None
+    if source == target:
+        return [source]
+    with TOPOLOGY_LOCK:
+        dist = {source: 0.0}
+        prev = {}
+        heap = [(0.0, source)]
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node == target:
+                break
+            if cost > dist.get(node, float("inf")):
+                continue
+            for neighbor, edge in MESH_GRAPH.get(node, {}).items():
+                if now - edge[1] > TOPOLOGY_EDGE_TTL:
+                    continue
+                new_cost = cost + edge_cost(edge, now)
+                if new_cost < dist.get(neighbor, float("inf")):
+                    dist[neighbor] = new_cost
+                    prev[neighbor] = node
+                    heapq.heappush(heap, (new_cost, neighbor))
+    if target not in prev:
+        return None
+    path = [target]
+    while path[-1] != source:
+        path.append(prev[path[-1]])
+    path.reverse()
+    return path
+
+def hop_distance(target):
+    if target in NODE_HOPS:
+        return NODE_HOPS[target][0]
+    path = best_route(target)
+    if path:
+        return len(path) - 2
+    return None
+
+def export_topology_dot(now=None):
+    now = now or time.time()
+    my_suffix = get_my_suffix()
+    lines = ["graph mesh {", "  node [shape=box];"]
+    with TOPOLOGY_LOCK:
+        nodes = list(MESH_GRAPH.keys())
+        edges = []
+        for node, neighbors in MESH_GRAPH.items():
+            for neighbor, edge in neighbors.items():
+                if node < neighbor:
+                    edges.append((node, neighbor, edge[0], edge[1]))
+    for node in nodes:
+        name = NODE_NAME_CACHE.get(node, node).replace('"', "'")
+        label = f"{name}\\n{node}" if name != node else node
+        hops = NODE_HOPS.get(node)
+        if hops:
+            label += f"\\n{hops[0]} хоп."
+        style = ", style=bold" if node == my_suffix else ""
+        lines.append(f'  "{node}" [label="{label}"{style}];')
+    for node_a, node_b, snr, last_seen in edges:
+        snr_label = f"{snr:.1f} dB" if snr is not None else "?"
+        age_min = int((now - last_seen) // 60)
+        lines.append(f'  "{node_a}" -- "{node_b}" [label="{snr_label}, {age_min} мин"];')
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def _grid_candidates(lat_min, lon_min, lat_max, lon_max):
+    """Суффиксы нод из ячеек сетки, пересекающих прямоугольник (без учёта перехода через 180°)"""
+    row_min, col_min = position_cell(lat_min, lon_min)
+    row_max, col_max = position_cell(lat_max, lon_max)
+    candidates = []
+    with POSITION_LOCK:
+        cells_in_box = (row_max - row_min + 1) * (col_max - col_min + 1)
+        # Большой прямоугольник: дешевле пройти только по занятым ячейкам
+        if cells_in_box > len(POSITION_GRID):
+            for (row, col), bucket in POSITION_GRID.items():
+                if row_min <= row <= row_max and col_min <= col <= col_max:
+                    candidates.extend(bucket)
+        else:
+            for row in range(row_min, row_max + 1):
+                for col in range(col_min, col_max + 1):
+                    bucket = POSITION_GRID.get((row, col))
+                    if bucket:
+                        candidates.extend(bucket)
+    return candidates
+
+def nodes_in_bbox(lat_min, lon_min, lat_max, lon_max):
+    lat_min, lat_max = max(min(lat_min, lat_max), -90.0), min(max(lat_min, lat_max), 90.0)
+    if lon_min <= lon_max:
+        ranges = [(lon_min, lon_max)]
+    else:
+        # прямоугольник пересекает меридиан 180°
+        ranges = [(lon_min, 180.0), (-180.0, lon_max)]
+
+    result = []
+    for lo, hi in ranges:
+        for suffix in _grid_candidates(lat_min, lo, lat_max, hi):
+            pos = NODE_POSITIONS.get(suffix)
+            if pos and lat_min <= pos[0] <= lat_max and lo <= pos[1] <= hi:
+                result.append((suffix, pos[0], pos[1]))
+    return result
+
+def nodes_near(lat, lon, radius_km):
+    """Ноды в радиусе radius_km, отсортированные по расстоянию"""
+    dlat = radius_km / 111.32
+    dlon = radius_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    lat_min, lat_max = lat - dlat, lat + dlat
+    if dlon >= 180:
+        lon_min, lon_max = -180.0, 180.0
+    else:
+        lon_min = lon - dlon if lon - dlon >= -180 else lon - dlon + 360
+        lon_max = lon + dlon if lon + dlon <= 180 else lon + dlon - 360
+
+    result = []
+    for suffix, node_lat, node_lon in nodes_in_bbox(lat_min, lon_min, lat_max, lon_max):
+        distance = haversine_km(lat, lon, node_lat, node_lon)
+        if distance <= radius_km:
+            result.append((distance, suffix))
+    result.sort()
+    return result
+
 async def daily_reboot_task():
     """Ежедневная перезагрузка в 00:15"""
     while True:
@@ -141,19 +695,20 @@ async def daily_reboot_task():
                 )
 
 async def notify_new_nodes():
-    global SEEN_NODES
     while True:
         try:
             if interface and hasattr(interface, 'nodes'):
-                current_nodes = set()
-                for node_id in interface.nodes:
+                new_nodes = []
+                now = time.time()
+                for node_id in list(interface.nodes):
                     suffix = get_node_suffix(node_id)
-                    if suffix:
-                        current_nodes.add(suffix)
+                    if not suffix:
+                        continue
+                    if suffix not in SEEN_NODES:
+                        new_nodes.append(suffix)
+                    SEEN_NODES[suffix] = now
 
-                new_nodes = current_nodes - SEEN_NODES
                 if new_nodes:
-                    SEEN_NODES.update(new_nodes)
                     names = [NODE_NAME_CACHE.get(s, s) for s in new_nodes]
                     message = "🆕 Обнаружены новые ноды:\n" + "\n".join(names)
                     if ADMIN_USER_ID and application:
@@ -199,10 +754,196 @@ async def auto_update_names():
     while True:
         try:
             update_node_name_cache()
+            sync_node_db()
         except Exception as e:
             logger.warning(f"Ошибка автообновления кэша: {e}")
         await asyncio.sleep(1800)
 
+async def watch_routes_task():
+    """Горячая перезагрузка routes.json при изменении файла"""
+    while True:
+        await asyncio.sleep(10)
+        try:
+            mtime = os.path.getmtime(ROUTES_FILE)
+        except OSError:
+            continue
+        if mtime != ROUTES_MTIME:
+            logger.info(f"🔄 {ROUTES_FILE} изменён, перезагрузка маршрутов")
+            load_routing_table()
+
+def flush_node_archive():
+    if not NODE_ARCHIVE_BUFFER:
+        return 0
+    records = []
+    while NODE_ARCHIVE_BUFFER:
+        records.append(NODE_ARCHIVE_BUFFER.popleft())
+    try:
+        with open(NODE_ARCHIVE_FILE, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось записать архив нод: {e}")
+        return 0
+    logger.info(f"🗄 В архив записано вытесненных записей: {len(records)}")
+    return len(records)
+
+def approx_size(obj):
+    """Размер контейнера вместе с ключами и значениями первого уровня"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in list(obj.items()):
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+    elif isinstance(obj, (set, list, deque)):
+        for item in list(obj):
+            size += sys.getsizeof(item)
+    return size
+
+def process_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def record_timing(name, started):
+    """Учитывает время обработчика: [вызовов, суммарно, максимум] в секундах"""
+    elapsed = time.perf_counter() - started
+    timing = HANDLER_TIMINGS.setdefault(name, [0, 0.0, 0.0])
+    timing[0] += 1
+    timing[1] += elapsed
+    if elapsed > timing[2]:
+        timing[2] = elapsed
+
+def format_timings():
+    lines = []
+    for name, (count, total, worst) in sorted(HANDLER_TIMINGS.items()):
+        avg = total / count * 1000 if count else 0.0
+        lines.append(f"{name}: {count} вызовов, ср. {avg:.2f} мс, макс. {worst * 1000:.1f} мс")
+    return lines
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _profiler_loop(stop, samples):
+    """Сэмплирует стеки всех потоков: event loop, чтение порта, публикация pubsub"""
+    own = threading.get_ident()
+    while not stop.wait(PROFILE_INTERVAL):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            key = names.get(ident, str(ident)) + ";" + ";".join(reversed(stack))
+            if key in samples or len(samples) < PROFILE_MAX_STACKS:
+                samples[key] = samples.get(key, 0) + 1
+        PROFILER["ticks"] += 1
+
+def start_profiler():
+    if PROFILER["thread"]:
+        return False
+    stop = threading.Event()
+    PROFILER.update(stop=stop, samples={}, ticks=0, started=time.time())
+    PROFILER["thread"] = threading.Thread(target=_profiler_loop, args=(stop, PROFILER["samples"]),
+                                          name="profiler", daemon=True)
+    PROFILER["thread"].start()
+    return True
+
+def stop_profiler():
+    """Останавливает сэмплер и возвращает отчёт: сводку и стеки в collapsed-формате"""
+    thread = PROFILER["thread"]
+    if not thread:
+        return None
+    PROFILER["stop"].set()
+    thread.join(timeout=2)
+    PROFILER["thread"] = None
+    samples = PROFILER["samples"]
+    duration = time.time() - PROFILER["started"]
+
+    leaves = {}
+    for key, count in samples.items():
+        frames = key.split(";")
+        leaf = (frames[0], frames[-1])
+        leaves[leaf] = leaves.get(leaf, 0) + count
+    total = sum(samples.values()) or 1
+
+    lines = [
+        f"# Профиль за {duration:.1f} с, {PROFILER['ticks']} срезов, интервал {PROFILE_INTERVAL * 1000:.1f} мс",
+        "# Топ функций по собственному времени (поток: функция):",
+    ]
+    for (thread_name, func), count in sorted(leaves.items(), key=lambda x: -x[1])[:30]:
+        lines.append(f"# {count * 100 / total:5.1f}%  {thread_name}: {func}")
+    lines.append("# Время обработчиков:")
+    lines.extend(f"# {line}" for line in format_timings())
+    lines.append("# Стеки (collapsed, для flamegraph.pl / speedscope):")
+    for key, count in sorted(samples.items(), key=lambda x: -x[1]):
+        lines.append(f"{key} {count}")
+    return "\n".join(lines) + "\n"
+
+def start_tracemalloc():
+    global TRACEMALLOC_BASELINE
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    TRACEMALLOC_BASELINE = tracemalloc.take_snapshot()
+
+def stop_tracemalloc():
+    global TRACEMALLOC_BASELINE
+    tracemalloc.stop()
+    TRACEMALLOC_BASELINE = None
+
+def tracemalloc_report(limit=30):
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Отслеживается: {current // 1024} КБ, пик {peak // 1024} КБ", "", "Топ по объёму:"]
+    lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:limit])
+    if TRACEMALLOC_BASELINE is not None:
+        lines.extend(["", "Рост с момента запуска:"])
+        lines.extend(str(stat) for stat in snapshot.compare_to(TRACEMALLOC_BASELINE, "lineno")[:limit])
+    return "\n".join(lines) + "\n"
+
+async def loop_lag_monitor():
+    global LOOP_LAG_MAX
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        LOOP_LAG_SAMPLES.append(lag)
+        if lag > LOOP_LAG_MAX:
+            LOOP_LAG_MAX = lag
+
+async def memory_maintenance_task():
+    while True:
+        await asyncio.sleep(60)
+        try:
+            flush_node_archive()
+        except Exception as e:
+            logger.warning(f"Ошибка архивации нод: {e}")
+
+async def topology_maintenance_task():
+    while True:
+        await asyncio.sleep(600)
+        try:
+            removed = prune_topology()
+            if removed:
+                logger.info(f"🕸 Удалено устаревших связей: {removed}")
+        except Exception as e:
+            logger.warning(f"Ошибка очистки топологии: {e}")
+
 async def monitor_meshtastic():
     last_warned = False
     while True:
@@ -221,6 +962,149 @@ async def monitor_meshtastic():
             logger.warning(f"Ошибка мониторинга Meshtastic: {e}")
             await asyncio.sleep(60)
 
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    direction TEXT NOT NULL,
+    channel INTEGER,
+    sender TEXT,
+    sender_name TEXT,
+    peer TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages(ts);
+CREATE INDEX IF NOT EXISTS messages_sender_ts ON messages(sender, ts);
+CREATE INDEX IF NOT EXISTS messages_peer_ts ON messages(peer, ts) WHERE peer IS NOT NULL;
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+def init_message_archive():
+    global MESSAGE_ARCHIVE_CONN
+    try:
+        conn = sqlite3.connect(MESSAGE_ARCHIVE_DB, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(ARCHIVE_SCHEMA)
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Архив сообщений отключён: {e}")
+        return False
+    MESSAGE_ARCHIVE_CONN = conn
+    logger.info(f"🗃 Архив сообщений: {MESSAGE_ARCHIVE_DB}")
+    return True
+
+def archive_message(direction, text, sender=None, sender_name=None, channel=None, peer=None):
+    """Вызывается в event loop; запись в базу идёт пачками из archive_flush_task"""
+    if MESSAGE_ARCHIVE_CONN is None:
+        return
+    MESSAGE_ARCHIVE_BUFFER.append((time.time(), direction, channel, sender, sender_name, peer, text))
+
+def write_message_archive(rows):
+    with MESSAGE_ARCHIVE_LOCK, MESSAGE_ARCHIVE_CONN:
+        MESSAGE_ARCHIVE_CONN.executemany(
+            "INSERT INTO messages (ts, direction, channel, sender, sender_name, peer, text) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+def prune_message_archive(now=None):
+    """Удаляет сообщения старше ARCHIVE_RETENTION_DAYS небольшими транзакциями"""
+    if ARCHIVE_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = (now or time.time()) - ARCHIVE_RETENTION_DAYS * 86400
+    removed = 0
+    while True:
+        with MESSAGE_ARCHIVE_LOCK, MESSAGE_ARCHIVE_CONN:
+            cursor = MESSAGE_ARCHIVE_CONN.execute(
+                "DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE ts < ? ORDER BY ts LIMIT 5000)",
+                (cutoff,)
+            )
+        removed += cursor.rowcount
+        if cursor.rowcount < 5000:
+            return removed
+
+async def archive_flush_task():
+    last_prune = 0
+    while True:
+        await asyncio.sleep(ARCHIVE_FLUSH_INTERVAL)
+        if MESSAGE_ARCHIVE_CONN is None:
+            continue
+        rows = []
+        while MESSAGE_ARCHIVE_BUFFER:
+            rows.append(MESSAGE_ARCHIVE_BUFFER.popleft())
+        try:
+            if rows:
+                await asyncio.to_thread(write_message_archive, rows)
+            if time.time() - last_prune > 3600:
+                last_prune = time.time()
+                removed = await asyncio.to_thread(prune_message_archive)
+                if removed:
+                    logger.info(f"🗃 Удалено старых сообщений из архива: {removed}")
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Ошибка записи архива сообщений: {e}")
+
+def fts_query(query):
+    """Каждое слово запроса берётся в кавычки, чтобы синтаксис FTS5 не ломал поиск"""
+    tokens = re.findall(r"\w+", query)
+    return " ".join(f'"{token}"' for token in tokens)
+
+def _archive_reader():
+    conn = sqlite3.connect(f"file:{MESSAGE_ARCHIVE_DB}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def search_message_archive(query, limit=20):
+    conn = _archive_reader()
+    try:
+        return conn.execute(
+            "SELECT m.ts, m.direction, m.channel, m.sender, m.sender_name, m.peer, "
+            "snippet(messages_fts, 0, '«', '»', '…', 16) AS text "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?",
+            (query, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+def node_message_history(suffix, limit=20):
+    conn = _archive_reader()
+    try:
+        return conn.execute(
+            "SELECT * FROM ("
+            "  SELECT ts, direction, channel, sender, sender_name, peer, text FROM messages "
+            "  WHERE sender = ? ORDER BY ts DESC LIMIT ?"
+            ") UNION ALL SELECT * FROM ("
+            "  SELECT ts, direction, channel, sender, sender_name, peer, text FROM messages "
+            "  WHERE peer = ? ORDER BY ts DESC LIMIT ?"
+            ") ORDER BY ts DESC LIMIT ?",
+            (suffix, limit, suffix, limit, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+def format_archive_row(row):
+    when = datetime.datetime.fromtimestamp(row["ts"]).strftime("%d.%m %H:%M")
+    arrow = {"mesh_to_tg": "📥", "mesh_only": "📡"}.get(row["direction"], "📤")
+    where = f"ch{row['channel']}" if row["channel"] is not None else "ЛС"
+    name = row["sender_name"] or row["sender"] or "?"
+    if row["peer"]:
+        name += f" → {NODE_NAME_CACHE.get(row['peer'], row['peer'])}"
+    text = row["text"] if len(row["text"]) <= 200 else row["text"][:200] + "…"
+    return f"{arrow} {when} {where} {name}: {text}"
+
 def split_message(text, max_length=80):
     if len(text) <= max_length:
         return [text]
@@ -237,68 +1121,616 @@ def split_message(text, max_length=80):
         parts.append(' '.join(current))
     return parts
 
-def on_meshtastic_message(packet, interface):
-    logger.debug(f"📥 Получено: {packet}")
+def _quota_tokens(key, limit, now):
+    bucket = QUOTA_BUCKETS.get(key)
+    if bucket is None:
+        return float(limit)
+    return min(float(limit), bucket[0] + (now - bucket[1]) * limit / 60.0)
+
+def admit_message(user_id, chat_id, cost, now=None):
+    """Token bucket по байтам в минуту для пользователя и чата.
+    Возвращает 0, если сообщение принято, иначе сколько секунд ждать."""
+    now = now or time.monotonic()
+    checks = []
+    for key, limit in ((("user", user_id), TG_QUOTA_USER_BYTES), (("chat", chat_id), TG_QUOTA_CHAT_BYTES)):
+        if limit <= 0:
+            continue
+        # длинное сообщение пропускается только при полном бакете, но списывается целиком:
+        # бакет уходит в минус, и следующие сообщения ждут, пока долг не восстановится
+        need = min(cost, limit)
+        tokens = _quota_tokens(key, limit, now)
+        checks.append((key, limit, need, tokens))
+
+    wait = max([(need - tokens) * 60.0 / limit for key, limit, need, tokens in checks if tokens < need] or [0])
+    if wait:
+        return wait
+
+    for key, limit, need, tokens in checks:
+        QUOTA_BUCKETS[key] = [tokens - cost, now]
+
+    if len(QUOTA_BUCKETS) > 1000:
+        # восстановившиеся до полного бакеты можно забыть
+        limits = {"user": TG_QUOTA_USER_BYTES, "chat": TG_QUOTA_CHAT_BYTES}
+        for key, bucket in list(QUOTA_BUCKETS.items()):
+            if _quota_tokens(key, limits[key[0]], now) >= limits[key[0]]:
+                del QUOTA_BUCKETS[key]
+    return 0
+
+def charge_airtime(chat_id, cost, now=None):
+    """Списывает эфир с бакета чата без проверки — для повторов уже принятых сообщений"""
+    if chat_id is None or TG_QUOTA_CHAT_BYTES <= 0:
+        return
+    now = now or time.monotonic()
+    key = ("chat", chat_id)
+    QUOTA_BUCKETS[key] = [_quota_tokens(key, TG_QUOTA_CHAT_BYTES, now) - cost, now]
+
+async def notify_over_quota(update, wait):
+    """Явный отказ: ответ не чаще раза в минуту на пользователя, иначе реакция"""
+    user_id = update.effective_user.id
+    now = time.monotonic()
     try:
-        from_id = packet.get('from')
-        to_id = packet.get('to', 0)
-        if from_id is None:
-            return
+        if now - QUOTA_NOTIFIED.get(user_id, -60.0) >= 60:
+            QUOTA_NOTIFIED[user_id] = now
+            await update.message.reply_text(
+                f"⏳ Лимит эфира исчерпан, сообщение не отправлено в mesh. Повторите через {int(wait) + 1} с"
+            )
+        else:
+            await update.message.set_reaction("😴")
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить о превышении лимита: {e}")
 
-        my_node_id = interface.myInfo.my_node_num if interface and hasattr(interface, 'myInfo') else None
-        is_direct = (to_id == my_node_id)
-
-        decoded = packet.get('decoded', {})
-        if 'user' in decoded:
-            user = decoded['user']
-            name = user.get('shortName') or user.get('longName')
-            if name:
-                suffix = f"{from_id & 0xFFFFFF:06X}"
-                old_name = NODE_NAME_CACHE.get(suffix)
-                if old_name != name:
-                    logger.info(f"✏️ Имя ноды {suffix} изменено: {old_name} → {name}")
-                NODE_NAME_CACHE[suffix] = name
-                save_node_name_cache()
+# ---------- Отслеживание доставки (ACK/NAK) ----------
+#
+# Доставка (delivery) — одно сообщение Telegram: считает свои пакеты и по
+# завершении всех вызывает callback (реакция или правка сообщения бота).
+# PENDING_ACKS — ограниченная таблица отправленных пакетов по id запроса.
 
-        suffix = f"{from_id & 0xFFFFFF:06X}"
-        sender_name = NODE_NAME_CACHE.get(suffix, suffix)
-
-        MESSAGE_STATS["mesh_to_tg"] += 1
-        NODE_MESSAGE_COUNT[suffix] = NODE_MESSAGE_COUNT.get(suffix, 0) + 1
-        today = time.strftime("%Y-%m-%d")
-        if suffix not in NODE_MESSAGE_HISTORY:
-            NODE_MESSAGE_HISTORY[suffix] = {}
-        NODE_MESSAGE_HISTORY[suffix][today] = NODE_MESSAGE_HISTORY[suffix].get(today, 0) + 1
-
-        if len(NODE_MESSAGE_HISTORY[suffix]) > MAX_HISTORY_DAYS:
-            sorted_days = sorted(NODE_MESSAGE_HISTORY[suffix].keys())
-            for day in sorted_days[:-MAX_HISTORY_DAYS]:
-                del NODE_MESSAGE_HISTORY[suffix][day]
-
-        if 'decoded' in packet and 'text' in packet['decoded']:
-            text = packet['decoded']['text']
-            channel = packet.get('channel', 0)
-            message = f"[{sender_name}]: {text}"
-
-            if is_direct:
-                if ADMIN_USER_ID and application:
-                    logger.info(f"🔐 Приватное сообщение → TG: {message}")
-                    asyncio.run_coroutine_threadsafe(
-                        application.bot.send_message(chat_id=ADMIN_USER_ID, text=message),
-                        MAIN_LOOP
-                    )
-            else:
-                chat_id = CHANNEL_TO_CHAT.get(channel)
-                if chat_id and application:
-                    logger.info(f"→ TG (ch{channel}): {message}")
-                    asyncio.run_coroutine_threadsafe(
-                        application.bot.send_message(chat_id=chat_id, text=message),
-                        MAIN_LOOP
-                    )
+def new_delivery(callback=None):
+    return {"pending": 0, "queued": 0, "delivered": 0, "relayed": 0, "failed": 0, "callback": callback}
+
+def _delivery_done(delivery, status):
+    if status is not None:
+        delivery["pending"] -= 1
+        delivery[status] += 1
+    if delivery["pending"] <= 0 and delivery["queued"] <= 0 and delivery["callback"] is not None:
+        callback, delivery["callback"] = delivery["callback"], None
+        asyncio.ensure_future(callback(delivery))
+
+def delivery_ok(delivery):
+    return not delivery["failed"] and (delivery["delivered"] or delivery["relayed"])
+
+def node_num(node_id):
+    if isinstance(node_id, str) and node_id.startswith('!'):
+        return int(node_id[1:], 16)
+    return node_id
+
+def _send_with_ack(entry):
+    kwargs = {"channelIndex": entry["channel"], "wantAck": True}
+    if entry["dest"] is not None:
+        kwargs["destinationId"] = entry["dest"]
+    packet = interface.sendText(entry["text"], **kwargs)
+    # RemoteInterface не знает id пакета: ключ временный, id придёт из радио-процесса
+    return packet.id if packet.id is not None else ("call", packet.call_id)
+
+def _track(key, entry):
+    PENDING_ACKS[key] = entry
+    while len(PENDING_ACKS) > ACK_MAX_PENDING:
+        old_key, old_entry = PENDING_ACKS.popitem(last=False)
+        logger.warning(f"⚠️ Таблица подтверждений переполнена, пакет {old_key} считается недоставленным")
+        _finish_entry(old_entry, "failed")
+
+def _finish_entry(entry, status, reason=None):
+    if status == "failed":
+        MESSAGE_STATS["mesh_failed"] += 1
+        logger.warning(f"❌ Не доставлено ({reason or 'нет подтверждения'}): {entry['text']}")
+    elif status == "delivered":
+        MESSAGE_STATS["mesh_acked"] += 1
+    for delivery in entry["deliveries"]:
+        _delivery_done(delivery, status)
+
+def send_tracked(text, deliveries, destination=None, channel=0, chat_id=None):
+    """sendText с wantAck и учётом в таблице подтверждений;
+    повторы списываются с лимита эфира чата chat_id"""
+    entry = {
+        "text": text,
+        "dest": node_num(destination) if destination is not None else None,
+        "channel": channel,
+        "chat_id": chat_id,
+        "attempt": 1,
+        "deadline": time.monotonic() + ACK_TIMEOUT,
+        "relayed": False,
+        "reason": None,
+        "deliveries": deliveries,
+    }
+    for delivery in deliveries:
+        delivery["pending"] += 1
+    try:
+        key = _send_with_ack(entry)
+    except Exception:
+        _finish_entry(entry, "failed", "ошибка отправки")
+        raise
+    _track(key, entry)
+    return key
+
+def bind_remote_packet_id(call_id, packet_id, error=None):
+    entry = PENDING_ACKS.pop(("call", call_id), None)
+    if entry is None:
+        return
+    if error or packet_id is None:
+        _finish_entry(entry, "failed", error)
+    else:
+        _track(packet_id, entry)
+
+def resolve_ack(request_id, from_num, reason):
+    entry = PENDING_ACKS.get(request_id)
+    if entry is None:
+        return
+    if reason == "NONE":
+        # Для широковещательных достаточно неявного ACK (ретрансляция услышана),
+        # для личных — только ACK от самого получателя
+        if entry["dest"] is None or from_num == entry["dest"]:
+            del PENDING_ACKS[request_id]
+            _finish_entry(entry, "delivered")
+        else:
+            entry["relayed"] = True
+    elif entry["dest"] is None and reason in ACK_BROADCAST_UNCONFIRMED:
+        del PENDING_ACKS[request_id]
+        logger.info(f"📡 Ретрансляция не услышана ({reason}), без повтора: {entry['text']}")
+        _finish_entry(entry, "relayed")
+    elif reason in ACK_RETRYABLE:
+        entry["reason"] = reason
+        entry["deadline"] = time.monotonic() + ACK_BACKOFF * 2 ** (entry["attempt"] - 1)
+    else:
+        del PENDING_ACKS[request_id]
+        _finish_entry(entry, "failed", reason)
+
+def check_ack_timeouts(now=None):
+    now = now or time.monotonic()
+    for key, entry in list(PENDING_ACKS.items()):
+        if entry["deadline"] > now:
+            continue
+        del PENDING_ACKS[key]
+        if entry["relayed"] or (entry["dest"] is None and entry["reason"] is None):
+            # широковещательный пакет без ответа прошивки не повторяем целиком
+            _finish_entry(entry, "relayed")
+        elif entry["attempt"] > ACK_MAX_RETRIES or not interface:
+            _finish_entry(entry, "failed", entry["reason"] or "TIMEOUT")
+        else:
+            entry["attempt"] += 1
+            entry["deadline"] = now + ACK_TIMEOUT * 2 ** (entry["attempt"] - 1)
+            MESSAGE_STATS["mesh_retries"] += 1
+            logger.info(f"🔁 Повтор {entry['attempt'] - 1}/{ACK_MAX_RETRIES} ({entry['reason'] or 'нет ACK'}): {entry['text']}")
+            entry["reason"] = None
+            charge_airtime(entry["chat_id"], len(entry["text"].encode("utf-8")), now)
+            try:
+                _track(_send_with_ack(entry), entry)
+            except Exception as e:
+                _finish_entry(entry, "failed", str(e))
+
+async def ack_monitor_task():
+    while True:
+        await asyncio.sleep(2)
+        try:
+            check_ack_timeouts()
+        except Exception as e:
+            logger.warning(f"Ошибка проверки подтверждений: {e}")
+
+async def react_delivery(message, delivery):
+    emoji = "👍" if delivery_ok(delivery) else "💔"
+    try:
+        await message.set_reaction(emoji)
+    except Exception as e:
+        logger.warning(f"Не удалось поставить реакцию доставки: {e}")
+
+async def edit_delivery_status(message, target_name, text, delivery):
+    if delivery["delivered"]:
+        status = f"✅ Доставлено {target_name}: {text}"
+    elif delivery_ok(delivery):
+        status = f"📡 Передано в сеть, подтверждения от {target_name} нет: {text}"
+    else:
+        status = f"❌ Не доставлено {target_name}: {text}"
+    try:
+        await message.edit_text(status)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить статус доставки: {e}")
+
+def pack_messages(items, max_length=MESH_TEXT_MAX):
+    """Упаковка коротких сообщений (имя, текст, ref) в минимальное число пакетов.
+    Возвращает список (текст пакета, [ref вошедших сообщений])."""
+    segments = []
+    for display_name, text, ref in items:
+        if segments and segments[-1][0] == display_name:
+            segments[-1][1].append(text)
+            segments[-1][2].append(ref)
+        else:
+            segments.append((display_name, [text], [ref]))
+
+    packets = []
+    current = ""
+    current_refs = []
+    for display_name, texts, refs in segments:
+        segment = f"[TG: {display_name}] " + " / ".join(texts)
+        if len(segment) > max_length:
+            if current:
+                packets.append((current, current_refs))
+                current, current_refs = "", []
+            parts = split_message(segment, max_length=max_length)
+            for i, part in enumerate(parts):
+                packets.append((f"{part} ({i+1}/{len(parts)})" if len(parts) > 1 else part, refs))
+            continue
+        candidate = f"{current}\n{segment}" if current else segment
+        if len(candidate) <= max_length:
+            current = candidate
+            current_refs = current_refs + refs
+        else:
+            packets.append((current, current_refs))
+            current, current_refs = segment, list(refs)
+    if current:
+        packets.append((current, current_refs))
+    return packets
+
+def queue_for_mesh(chat_id, channel, display_name, text, delivery):
+    key = (chat_id, channel)
+    delivery["queued"] += 1
+    buffer = COALESCE_BUFFERS.get(key)
+    if buffer is None:
+        COALESCE_BUFFERS[key] = [(display_name, text, delivery)]
+        asyncio.create_task(flush_mesh_buffer(key))
+    else:
+        buffer.append((display_name, text, delivery))
+
+async def flush_mesh_buffer(key):
+    await asyncio.sleep(COALESCE_WINDOW)
+    items = COALESCE_BUFFERS.pop(key, [])
+    if not items:
+        return
+    chat_id, channel = key
+    packets = pack_messages(items)
+    if len(items) > 1:
+        MESSAGE_STATS["tg_coalesced"] += len(items) - 1
+        logger.info(f"📦 {len(items)} сообщений из чата {chat_id} объединены в {len(packets)} пакет(а)")
+
+    # пакеты одного канала уходят последовательно, даже если окна разных чатов совпали
+    lock = MESH_SEND_LOCKS.setdefault(channel, asyncio.Lock())
+    async with lock:
+        for i, (part, deliveries) in enumerate(packets):
+            try:
+                logger.info(f"→ Mesh (ch{channel}): {part}")
+                if interface:
+                    send_tracked(part, deliveries, channel=channel, chat_id=chat_id)
+                    MESSAGE_STATS["tg_to_mesh"] += 1
+                if i < len(packets) - 1:
+                    await asyncio.sleep(0.8)
+            except Exception as e:
+                logger.exception(f"Ошибка отправки части {i+1} в Meshtastic")
+
+    # все пакеты буфера учтены — доставки можно завершать
+    for _, _, delivery in items:
+        delivery["queued"] -= 1
+        _delivery_done(delivery, None)
+
+def parse_message_part(text):
+    """'текст (2/3)' → (текст, 2, 3); None, если это не часть длинного сообщения"""
+    match = MULTIPART_RE.match(text)
+    if not match:
+        return None
+    index, total = int(match.group(2)), int(match.group(3))
+    if not (1 < total <= MULTIPART_MAX_PARTS and 1 <= index <= total):
+        return None
+    return match.group(1), index, total
+
+def render_multipart(entry):
+    parts = entry["parts"]
+    body = " ".join(parts.get(i, "…") for i in range(1, entry["total"] + 1))
+    if len(parts) < entry["total"]:
+        body += f" [{len(parts)}/{entry['total']}]"
+    return body
+
+def add_message_part(key, sender_name, index, total, text, routes):
+    """Вызывается в event loop. key = (суффикс отправителя, канал или "dm"),
+    routes = маршруты канала или None для личных сообщений."""
+    now = time.monotonic()
+    entry = MULTIPART_BUFFERS.get(key)
+    if entry and entry["total"] == total and entry["parts"].get(index) == text:
+        return  # повтор уже полученной части
+    if entry and (entry["total"] != total or index in entry["parts"] or len(entry["parts"]) == total
+                  or (entry["emitted"] and now - entry["last_part"] > MULTIPART_TIMEOUT)):
+        # началась новая серия частей — старую отправляем как есть; в уже отправленное
+        # сообщение дописываются только части, пришедшие вскоре после предыдущей
+        emit_multipart(key, entry)
+        entry = None
+    if entry is None:
+        entry = {
+            "total": total, "parts": {}, "sender_name": sender_name, "routes": routes,
+            "emitted": False, "messages": None, "rendered": None, "busy": False, "timer": None,
+            "archived": False,
+        }
+        MULTIPART_BUFFERS[key] = entry
+        entry["timer"] = MAIN_LOOP.call_later(MULTIPART_TIMEOUT, emit_multipart, key, entry)
+    entry["parts"][index] = text
+    entry["last_part"] = now
+    MESSAGE_STATS["mesh_parts"] += 1
+
+    if entry["emitted"]:
+        # опоздавшая часть — дописываем в уже отправленное сообщение
+        asyncio.create_task(sync_multipart(key, entry))
+    elif len(entry["parts"]) == total:
+        emit_multipart(key, entry)
+
+def emit_multipart(key, entry):
+    if entry["emitted"]:
+        return
+    entry["emitted"] = True
+    entry["timer"].cancel()
+    MESSAGE_STATS["mesh_reassembled"] += 1
+    if len(entry["parts"]) < entry["total"]:
+        logger.info(f"🧩 Сборка {key} по таймауту: {len(entry['parts'])}/{entry['total']} частей")
+    asyncio.create_task(sync_multipart(key, entry))
+    MAIN_LOOP.call_later(MULTIPART_EDIT_WINDOW, _expire_multipart, key, entry)
+
+def archive_multipart(key, entry):
+    """Собранный текст архивируется один раз: когда пришли все части или по истечении окна правок"""
+    if entry["archived"]:
+        return
+    entry["archived"] = True
+    body = " ".join(entry["parts"][i] for i in sorted(entry["parts"]))
+    archive_message("mesh_to_tg" if entry["messages"] else "mesh_only", body, sender=key[0],
+                    sender_name=entry["sender_name"], channel=None if key[1] == "dm" else key[1])
+
+def _expire_multipart(key, entry):
+    archive_multipart(key, entry)
+    if MULTIPART_BUFFERS.get(key) is entry:
+        del MULTIPART_BUFFERS[key]
+
+async def sync_multipart(key, entry):
+    """Отправляет собранное сообщение, а при появлении новых частей редактирует его"""
+    if entry["busy"]:
+        return
+    entry["busy"] = True
+    try:
+        while True:
+            body = render_multipart(entry)
+            if body == entry["rendered"]:
+                break
+            message = f"[{entry['sender_name']}]: {body}"
+            if entry["messages"] is None:
+                entry["messages"] = []
+                if entry["routes"] is None:
+                    chat_ids = [ADMIN_USER_ID]
                 else:
-                    logger.warning(f"Сообщение в неизвестном канале: {channel}")
+                    chat_ids = list(dict.fromkeys(
+                        route["chat_id"] for route in entry["routes"] if route_allows(route, body, key[0])
+                    ))
+                for chat_id in chat_ids:
+                    logger.info(f"→ TG ({key[1]} → {chat_id}): {message}")
+                    try:
+                        sent = await application.bot.send_message(chat_id=chat_id, text=message)
+                        entry["messages"].append(sent)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Не удалось отправить собранное сообщение в {chat_id}: {e}")
+            else:
+                for sent in entry["messages"]:
+                    try:
+                        await application.bot.edit_message_text(
+                            chat_id=sent.chat_id, message_id=sent.message_id, text=message
+                        )
+                    except Exception as e:
+                        logger.warning(f"⚠️ Не удалось дописать сообщение в {sent.chat_id}: {e}")
+            entry["rendered"] = body
+        if len(entry["parts"]) == entry["total"]:
+            archive_multipart(key, entry)
+    finally:
+        entry["busy"] = False
+
+def on_meshtastic_receive(packet, interface, topic=pub.AUTO_TOPIC):
+    """Колбэк потока чтения meshtastic: только передаёт пакет в event loop,
+    вся обработка идёт в inbound_pipeline_task"""
+    started = time.perf_counter()
+    try:
+        MAIN_LOOP.call_soon_threadsafe(enqueue_packet, topic.getName(), packet, interface, time.monotonic())
+    except RuntimeError:
+        # event loop уже закрыт — бот завершается
+        PIPELINE_STATS["dropped"] += 1
+    finally:
+        record_timing("on_meshtastic_receive", started)
+
+def enqueue_packet(topic, packet, interface, received_at):
+    PIPELINE_STATS["received"] += 1
+    try:
+        INBOUND_QUEUE.put_nowait((topic, packet, interface, received_at))
+    except asyncio.QueueFull:
+        PIPELINE_STATS["dropped"] += 1
+        if PIPELINE_STATS["dropped"] % 100 == 1:
+            logger.warning(f"⚠️ Очередь входящих пакетов переполнена, отброшено: {PIPELINE_STATS['dropped']}")
+        return
+    depth = INBOUND_QUEUE.qsize()
+    if depth > PIPELINE_STATS["max_depth"]:
+        PIPELINE_STATS["max_depth"] = depth
+
+def is_duplicate_packet(packet):
+    packet_id = packet.get('id')
+    if not packet_id or packet.get('from') is None:
+        return False
+    key = (packet['from'], packet_id)
+    if key in RECENT_PACKET_IDS:
+        return True
+    RECENT_PACKET_IDS[key] = True
+    return False
+
+def schedule_name_save():
+    """Кэш имён пишется на диск не чаще раза в NAME_SAVE_DELAY секунд"""
+    global NAME_SAVE_HANDLE
+    if NAME_SAVE_HANDLE is None:
+        NAME_SAVE_HANDLE = MAIN_LOOP.call_later(NAME_SAVE_DELAY, _flush_name_save)
+
+def _flush_name_save():
+    global NAME_SAVE_HANDLE
+    NAME_SAVE_HANDLE = None
+    save_node_name_cache()
+
+def handle_user_info(packet):
+    from_id = packet.get('from')
+    user = packet.get('decoded', {}).get('user')
+    if from_id is None or not user:
+        return
+    name = user.get('shortName') or user.get('longName')
+    if not name:
+        return
+    suffix = f"{from_id & 0xFFFFFF:06X}"
+    old_name = NODE_NAME_CACHE.get(suffix)
+    NODE_NAME_CACHE[suffix] = name
+    if old_name != name:
+        logger.info(f"✏️ Имя ноды {suffix} изменено: {old_name} → {name}")
+        schedule_name_save()
+
+def handle_text_packet(packet, interface, outgoing):
+    """Статистика и маршрутизация текстового пакета; сообщения для Telegram
+    складываются в outgoing (chat_id → [строки]) и отправляются пачкой"""
+    from_id = packet.get('from')
+    to_id = packet.get('to', 0)
+    if from_id is None:
+        return
+
+    my_node_id = interface.myInfo.my_node_num if interface and hasattr(interface, 'myInfo') else None
+    is_direct = (to_id == my_node_id)
+
+    suffix = f"{from_id & 0xFFFFFF:06X}"
+    sender_name = NODE_NAME_CACHE.get(suffix, suffix)
+
+    MESSAGE_STATS["mesh_to_tg"] += 1
+    NODE_MESSAGE_COUNT[suffix] = NODE_MESSAGE_COUNT.get(suffix, 0) + 1
+    today = time.strftime("%Y-%m-%d")
+    days = NODE_MESSAGE_HISTORY.get(suffix, {})
+    days[today] = days.get(today, 0) + 1
+
+    if len(days) > MAX_HISTORY_DAYS:
+        sorted_days = sorted(days.keys())
+        for day in sorted_days[:-MAX_HISTORY_DAYS]:
+            del days[day]
+    NODE_MESSAGE_HISTORY[suffix] = days
+
+    text = packet.get('decoded', {}).get('text')
+    if text is None:
+        return
+    channel = packet.get('channel', 0)
+    message = f"[{sender_name}]: {text}"
+
+    part = parse_message_part(text)
+    if part and application:
+        routes = None if is_direct else ROUTING_TABLE["forward"].get(channel)
+        if (is_direct and ADMIN_USER_ID) or routes:
+            body, index, total = part
+            key = (suffix, "dm" if is_direct else channel)
+            logger.info(f"🧩 Часть {index}/{total} от {sender_name} ({key[1]})")
+            # в архив попадёт собранный текст, см. archive_multipart
+            add_message_part(key, sender_name, index, total, body, routes)
+            return
+
+    chat_ids = {}
+    if is_direct:
+        if ADMIN_USER_ID and application:
+            logger.info(f"🔐 Приватное сообщение → TG: {message}")
+            chat_ids = {ADMIN_USER_ID: None}
+    else:
+        routes = ROUTING_TABLE["forward"].get(channel)
+        if not routes:
+            logger.warning(f"Сообщение в неизвестном канале: {channel}")
+        elif application:
+            # несколько маршрутов канала могут вести в один чат — отправляем в него один раз
+            chat_ids = dict.fromkeys(r["chat_id"] for r in routes if route_allows(r, text, suffix))
+            for chat_id in chat_ids:
+                logger.info(f"→ TG (ch{channel} → {chat_id}): {message}")
+    for chat_id in chat_ids:
+        outgoing.setdefault(chat_id, []).append(message)
+    archive_message("mesh_to_tg" if chat_ids else "mesh_only", text, sender=suffix, sender_name=sender_name,
+                    channel=None if is_direct else channel)
+
+def handle_routing_packet(packet):
+    decoded = packet.get('decoded', {})
+    request_id = decoded.get('requestId')
+    if request_id is None:
+        return
+    reason = decoded.get('routing', {}).get('errorReason', 'NONE')
+    resolve_ack(request_id, packet.get('from'), reason)
+
+def handle_position_packet(packet):
+    from_id = packet.get('from')
+    if from_id is None:
+        return
+    coords = extract_position(packet.get('decoded', {}).get('position'))
+    if coords is None:
+        return
+    suffix = f"{from_id & 0xFFFFFF:06X}"
+    if update_node_position(suffix, coords[0], coords[1], packet.get('rxTime')):
+        logger.debug(f"📍 Позиция {suffix}: {coords[0]:.5f}, {coords[1]:.5f}")
+
+def process_packet(topic, packet, interface, outgoing):
+    logger.debug(f"📥 Получено ({topic}): {packet}")
+    from_id = packet.get('from')
+    if from_id is not None:
+        # свежесть кэша имён — по любому услышанному пакету, а не только по тексту
+        NODE_NAME_CACHE.touch(f"{from_id & 0xFFFFFF:06X}")
+    handle_user_info(packet)
+    ingest_topology(packet)
+    if topic == "meshtastic.receive.text":
+        handle_text_packet(packet, interface, outgoing)
+    elif topic == "meshtastic.receive.position":
+        handle_position_packet(packet)
+    elif topic == "meshtastic.receive.routing":
+        handle_routing_packet(packet)
+
+async def send_to_chat(chat_id, text):
+    try:
+        await application.bot.send_message(chat_id=chat_id, text=text)
     except Exception as e:
-        logger.exception("Ошибка в обработчике Meshtastic")
+        logger.warning(f"⚠️ Не удалось отправить сообщение в {chat_id}: {e}")
+
+def deliver_batch(outgoing):
+    """Сообщения пачки для одного чата уходят одним сообщением Telegram"""
+    for chat_id, lines in outgoing.items():
+        PIPELINE_STATS["tg_merged"] += len(lines) - 1
+        chunk = ""
+        for line in lines:
+            if chunk and len(chunk) + 1 + len(line) > TELEGRAM_TEXT_MAX:
+                asyncio.create_task(send_to_chat(chat_id, chunk))
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line
+        if chunk:
+            asyncio.create_task(send_to_chat(chat_id, chunk))
+
+async def inbound_pipeline_task():
+    """Единственный потребитель очереди входящих пакетов. Стадии выполняются
+    последовательно в одной задаче: дедупликация → свежесть/имена → топология →
+    обработчик топика (статистика, маршрутизация, позиции, ACK) → доставка пачкой.
+    Отдельные задачи на каждую стадию в одном event loop ничего бы не распараллелили.
+    Декодирование protobuf остаётся в потоке чтения meshtastic: библиотека
+    публикует в pubsub уже разобранный пакет."""
+    while True:
+        batch = [await INBOUND_QUEUE.get()]
+        while len(batch) < INBOUND_BATCH_MAX and not INBOUND_QUEUE.empty():
+            batch.append(INBOUND_QUEUE.get_nowait())
+
+        started = time.perf_counter()
+        now = time.monotonic()
+        PIPELINE_STATS["batches"] += 1
+        PIPELINE_STATS["max_batch"] = max(PIPELINE_STATS["max_batch"], len(batch))
+        outgoing = {}
+        for topic, packet, interface, received_at in batch:
+            PIPELINE_WAIT.append(now - received_at)
+            if is_duplicate_packet(packet):
+                PIPELINE_STATS["duplicates"] += 1
+                continue
+            try:
+                process_packet(topic, packet, interface, outgoing)
+                PIPELINE_STATS["processed"] += 1
+            except Exception:
+                PIPELINE_STATS["errors"] += 1
+                logger.exception(f"Ошибка обработки пакета {topic}")
+        if outgoing:
+            deliver_batch(outgoing)
+        record_timing("inbound_batch", started)
+        # отдаём управление Telegram и остальным задачам между пачками
+        await asyncio.sleep(0)
 
 async def telegram_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -308,27 +1740,28 @@ async def telegram_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     display_name = user.full_name or user.username or f"tg_{user.id}"
 
-    channel = None
-    for ch_index, ch_chat_id in CHANNEL_TO_CHAT.items():
-        if ch_chat_id == chat_id:
-            channel = ch_index
-            break
+    routes = ROUTING_TABLE["reverse"].get(chat_id)
+    if not routes:
+        logger.warning(f"Нет маршрута для чата {chat_id}, сообщение не отправлено в mesh")
+        return
+    # один канал может быть указан в нескольких маршрутах чата — отправляем в него один раз
+    channels = list(dict.fromkeys(r["channel"] for r in routes if route_allows(r, text)))
 
-    enriched_text = f"[TG: {display_name}] {text}"
-    parts = split_message(enriched_text, max_length=80)
+    if not channels:
+        return
 
-    for i, part in enumerate(parts):
-        try:
-            if len(parts) > 1:
-                part = f"{part} ({i+1}/{len(parts)})"
-            logger.info(f"→ Mesh (ch{channel}): {part}")
-            if interface:
-                interface.sendText(part, channelIndex=channel)
-                MESSAGE_STATS["tg_to_mesh"] += 1
-            if i < len(parts) - 1:
-                await asyncio.sleep(0.8)
-        except Exception as e:
-            logger.exception(f"Ошибка отправки части {i+1} в Meshtastic")
+    cost = len(f"[TG: {display_name}] {text}".encode("utf-8")) * len(channels)
+    wait = admit_message(user.id, chat_id, cost)
+    if wait:
+        MESSAGE_STATS["tg_over_quota"] += 1
+        logger.info(f"⛔ Лимит эфира: {display_name} в чате {chat_id}, ожидание {wait:.0f} с")
+        await notify_over_quota(update, wait)
+        return
+
+    delivery = new_delivery(functools.partial(react_delivery, update.message))
+    for channel in channels:
+        queue_for_mesh(chat_id, channel, display_name, text, delivery)
+        archive_message("tg_to_mesh", text, sender=f"tg:{user.id}", sender_name=display_name, channel=channel)
 
 async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
@@ -338,6 +1771,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id != ADMIN_USER_ID:
         return
 
+    started = time.perf_counter()
     try:
         raw_text = update.message.text.strip()
         if not raw_text:
@@ -352,7 +1786,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_text = parts_at[1]
 
             target_suffix = None
-            for suffix, name in NODE_NAME_CACHE.items():
+            for suffix, name in list(NODE_NAME_CACHE.items()):
                 if name == target_name or suffix == target_name.upper():
                     target_suffix = suffix
                     break
@@ -372,11 +1806,16 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(f"❌ Нода '{target_name}' не в сети")
                 return
 
+            status = await update.message.reply_text(f"📨 Отправлено {target_name}: {message_text}")
+            delivery = new_delivery()
             try:
-                interface.sendText(message_text, destinationId=target_id, channelIndex=0)
-                await update.message.reply_text(f"📨 Отправлено {target_name}: {message_text}")
+                send_tracked(message_text, [delivery], destination=target_id, channel=0)
             except Exception as e:
-                await update.message.reply_text(f"⚠️ Ошибка: {e}")
+                await status.edit_text(f"⚠️ Ошибка: {e}")
+                return
+            delivery["callback"] = functools.partial(edit_delivery_status, status, target_name, message_text)
+            archive_message("tg_to_mesh", message_text, sender=f"tg:{user_id}",
+                            sender_name=update.effective_user.full_name, peer=target_suffix)
             return
 
         if raw_text.startswith("/"):
@@ -393,11 +1832,24 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "📊 Команды статистики:\n"
                     "/stats — полная статистика\n"
                     "/direct — прямые соседи\n"
+                    "/route <имя> — хопы и лучший ретранслятор\n"
+                    "/topology — граф сети (Graphviz)\n"
                     "/battery — заряд батареи\n"
                     "/lastseen — последний контакт\n"
+                    "/near <имя|lat lon> <км> — ноды поблизости\n"
+                    "/search <слова> — поиск по архиву сообщений\n"
+                    "/history <имя> — последние сообщения ноды\n"
+                    "/bbox <lat1> <lon1> <lat2> <lon2> — ноды в области\n"
                     "\n🛠️ Команды управления:\n"
                     "/reload_names — обновить кэш имён\n"
+                    "/routes — маршруты каналов и чатов\n"
+                    "/reload_routes — перечитать routes.json\n"
                     "/dump_cache — показать кэш\n"
+                    "/memory — размеры структур в памяти\n"
+                    "/loop_lag — задержка event loop\n"
+                    "/pipeline — очередь входящих пакетов\n"
+                    "/profile start|stop — сэмплирующий профайлер\n"
+                    "/tracemalloc start|top|stop — аллокации памяти\n"
                     "/reset_cache — очистить кэш\n"
                     "/reset_nodedb — сбросить базу нод\n"
                     "/reboot — перезагрузка\n"
@@ -415,7 +1867,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if cmd == "fav_add" and args:
                 target = args[0].upper()
                 target_suffix = None
-                for suffix, name in NODE_NAME_CACHE.items():
+                for suffix, name in list(NODE_NAME_CACHE.items()):
                     if name == target or suffix == target:
                         target_suffix = suffix
                         break
@@ -488,18 +1940,95 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         snr = node.get('snr', 'N/A')
                         last_heard = node.get('lastHeard', 0)
                         voltage = node.get('deviceMetrics', {}).get('voltage', 'N/A')
+                        distance = node_distance_km(get_my_suffix(), node_suffix)
                         reply = (
                             f"ℹ️ Нода {name} ({node_suffix}):\n"
                             f"SNR: {snr}\n"
                             f"Батарея: {voltage}\n"
                             f"Последний контакт: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_heard))}"
                         )
+                        if distance is not None:
+                            reply += f"\nРасстояние: {distance:.2f} км"
                         await update.message.reply_text(reply)
                         break
                 if not found:
                     await update.message.reply_text(f"❌ Нода {suffix} не найдена")
                 return
 
+            if cmd == "near" and len(args) >= 2:
+                try:
+                    radius = float(args[-1])
+                    if len(args) >= 3:
+                        lat, lon = float(args[0]), float(args[1])
+                        center_suffix = None
+                        center_name = f"{lat:.5f}, {lon:.5f}"
+                    else:
+                        center_suffix = find_node_suffix(args[0])
+                        pos = NODE_POSITIONS.get(center_suffix) if center_suffix else None
+                        if pos is None:
+                            await update.message.reply_text(f"❌ Позиция ноды '{args[0]}' неизвестна")
+                            return
+                        lat, lon = pos[0], pos[1]
+                        center_name = NODE_NAME_CACHE.get(center_suffix, center_suffix)
+                except ValueError:
+                    await update.message.reply_text("❌ Формат: /near <имя|lat lon> <км>")
+                    return
+
+                found = [(d, s) for d, s in nodes_near(lat, lon, radius) if s != center_suffix]
+                if found:
+                    lines = [f"{NODE_NAME_CACHE.get(s, s)}: {d:.2f} км" for d, s in found[:20]]
+                    reply = f"📍 Ноды в радиусе {radius:g} км от {center_name} ({len(found)}):\n" + "\n".join(lines)
+                else:
+                    reply = f"📍 Нод в радиусе {radius:g} км от {center_name} не найдено"
+                await update.message.reply_text(reply)
+                return
+
+            if cmd == "bbox" and len(args) >= 4:
+                try:
+                    lat1, lon1, lat2, lon2 = (float(a) for a in args[:4])
+                except ValueError:
+                    await update.message.reply_text("❌ Формат: /bbox <lat1> <lon1> <lat2> <lon2>")
+                    return
+                found = nodes_in_bbox(lat1, lon1, lat2, lon2)
+                if found:
+                    found.sort(key=lambda x: NODE_NAME_CACHE.get(x[0], x[0]))
+                    lines = [f"{NODE_NAME_CACHE.get(s, s)}: {lat:.5f}, {lon:.5f}" for s, lat, lon in found[:30]]
+                    reply = f"🗺 Ноды в области ({len(found)}):\n" + "\n".join(lines)
+                else:
+                    reply = "🗺 Нод в области не найдено"
+                await update.message.reply_text(reply)
+                return
+
+            if cmd in ("search", "history"):
+                if MESSAGE_ARCHIVE_CONN is None:
+                    await update.message.reply_text("❌ Архив сообщений недоступен")
+                    return
+                if cmd == "search":
+                    query = fts_query(" ".join(args))
+                    if not query:
+                        await update.message.reply_text("❌ Формат: /search <слова>")
+                        return
+                    rows = await asyncio.to_thread(search_message_archive, query)
+                    header = f"🔎 Найдено по запросу «{' '.join(args)}»:"
+                else:
+                    target_suffix = find_node_suffix(args[0]) if args else None
+                    if not target_suffix and args:
+                        # нода могла быть вытеснена из кэша имён, а в архиве её сообщения есть
+                        target = args[0].upper()
+                        if len(target) == 6 and all(c in "0123456789ABCDEF" for c in target):
+                            target_suffix = target
+                    if not target_suffix:
+                        await update.message.reply_text("❌ Формат: /history <имя или суффикс ноды (6 hex)>")
+                        return
+                    rows = await asyncio.to_thread(node_message_history, target_suffix)
+                    header = f"🗂 Сообщения {NODE_NAME_CACHE.get(target_suffix, target_suffix)}:"
+                if not rows:
+                    await update.message.reply_text("🔎 Ничего не найдено")
+                    return
+                reply = header + "\n" + "\n".join(format_archive_row(row) for row in rows)
+                await update.message.reply_text(reply[:TELEGRAM_TEXT_MAX])
+                return
+
             if cmd == "topnodes":
                 if NODE_MESSAGE_COUNT:
                     top = sorted(NODE_MESSAGE_COUNT.items(), key=lambda x: x[1], reverse=True)[:5]
@@ -550,7 +2079,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if cmd == "stats_today":
                 today = time.strftime("%Y-%m-%d")
                 lines = []
-                for suffix, days in NODE_MESSAGE_HISTORY.items():
+                for suffix, days in list(NODE_MESSAGE_HISTORY.items()):
                     count = days.get(today, 0)
                     if count > 0:
                         lines.append(f"{NODE_NAME_CACHE.get(suffix, suffix)}: {count}")
@@ -580,8 +2109,8 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             if cmd == "reset_cache":
+                # SEEN_NODES не очищается: иначе все известные ноды снова придут как «новые»
                 NODE_NAME_CACHE.clear()
-                SEEN_NODES.clear()
                 save_node_name_cache()
                 await update.message.reply_text("🗑 Кэш имён очищен.")
                 return
@@ -607,9 +2136,147 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(reply)
                 return
 
+            if cmd == "routes":
+                table = ROUTING_TABLE
+                if not table["routes"]:
+                    await update.message.reply_text("Маршрутов нет")
+                    return
+                arrows = {"both": "↔", "mesh_to_tg": "→", "tg_to_mesh": "←"}
+                lines = []
+                for route in table["routes"]:
+                    line = f"ch{route['channel']} {arrows[route['direction']]} {route['chat_id']}"
+                    filters_text = []
+                    if route["include"] is not None:
+                        filters_text.append(f"include={route['include'].pattern}")
+                    if route["exclude"] is not None:
+                        filters_text.append(f"exclude={route['exclude'].pattern}")
+                    if route["nodes"] is not None:
+                        filters_text.append("nodes=" + ",".join(sorted(route["nodes"])))
+                    if filters_text:
+                        line += " (" + "; ".join(filters_text) + ")"
+                    lines.append(line)
+                await update.message.reply_text(f"🔀 Маршруты ({len(lines)}):\n" + "\n".join(lines))
+                return
+
+            if cmd == "reload_routes":
+                if load_routing_table():
+                    await update.message.reply_text(f"✅ Маршруты перезагружены: {len(ROUTING_TABLE['routes'])}")
+                else:
+                    await update.message.reply_text("⚠️ Ошибка загрузки маршрутов, действует прежняя таблица")
+                return
+
+            if cmd == "memory":
+                lines = []
+                for name, structure in MEMORY_STRUCTURES.items():
+                    lines.append(
+                        f"{name}: {len(structure)}/{structure.maxsize}, "
+                        f"~{approx_size(structure) // 1024} КБ, вытеснено {structure.evicted}"
+                    )
+                others = {
+                    "position_grid": POSITION_GRID,
+                    "pending_acks": PENDING_ACKS,
+                    "quota_buckets": QUOTA_BUCKETS,
+                    "coalesce_buffers": COALESCE_BUFFERS,
+                    "multipart_buffers": MULTIPART_BUFFERS,
+                    "battery_low_notified": BATTERY_LOW_NOTIFIED,
+                    "archive_buffer": NODE_ARCHIVE_BUFFER,
+                    "message_archive_buffer": MESSAGE_ARCHIVE_BUFFER,
+                }
+                for name, structure in others.items():
+                    lines.append(f"{name}: {len(structure)}, ~{approx_size(structure) // 1024} КБ")
+                rss = process_rss_kb()
+                header = "🧠 Память" + (f" (RSS {rss // 1024} МБ)" if rss else "") + ":"
+                await update.message.reply_text(header + "\n" + "\n".join(lines))
+                return
+
+            if cmd == "loop_lag":
+                samples = list(LOOP_LAG_SAMPLES)
+                lines = [
+                    f"⏱ Задержка event loop за {len(samples) * LOOP_LAG_INTERVAL:.0f} с (мс):",
+                    f"p50 {percentile(samples, 50) * 1000:.1f} / p95 {percentile(samples, 95) * 1000:.1f} / "
+                    f"p99 {percentile(samples, 99) * 1000:.1f} / max {max(samples, default=0) * 1000:.1f}",
+                    f"Максимум с запуска: {LOOP_LAG_MAX * 1000:.1f}",
+                ]
+                timings = format_timings()
+                if timings:
+                    lines.append("\nОбработчики:")
+                    lines.extend(timings)
+                await update.message.reply_document(
+                    document=io.BytesIO(("\n".join(lines) + "\n").encode("utf-8")),
+                    filename="loop_lag.txt",
+                    caption=f"⏱ Задержка event loop, мс: {lines[1]}"
+                )
+                return
+
+            if cmd == "pipeline":
+                stats = PIPELINE_STATS
+                waits = list(PIPELINE_WAIT)
+                avg_batch = stats["processed"] / stats["batches"] if stats["batches"] else 0.0
+                depth = INBOUND_QUEUE.qsize() if INBOUND_QUEUE else 0
+                lines = [
+                    "📥 Конвейер входящих пакетов:",
+                    f"Получено {stats['received']}, обработано {stats['processed']}, "
+                    f"дубликатов {stats['duplicates']}, ошибок {stats['errors']}",
+                    f"Отброшено при переполнении: {stats['dropped']}",
+                    f"Очередь: {depth}/{INBOUND_QUEUE_SIZE}, максимум {stats['max_depth']}",
+                    f"Пачки: {stats['batches']}, в среднем {avg_batch:.1f}, максимум {stats['max_batch']}",
+                    f"Ожидание в очереди (мс): p50 {percentile(waits, 50) * 1000:.1f} / "
+                    f"p95 {percentile(waits, 95) * 1000:.1f} / max {max(waits, default=0) * 1000:.1f}",
+                    f"Объединено сообщений в Telegram: {stats['tg_merged']}",
+                ]
+                await update.message.reply_text("\n".join(lines))
+                return
+
+            if cmd == "profile":
+                action = args[0].lower() if args else ""
+                if action == "start":
+                    if start_profiler():
+                        await update.message.reply_text(
+                            f"🔬 Профайлер запущен (интервал {PROFILE_INTERVAL * 1000:.1f} мс), остановка: /profile stop"
+                        )
+                    else:
+                        await update.message.reply_text("⚠️ Профайлер уже запущен")
+                elif action == "stop":
+                    report = await asyncio.to_thread(stop_profiler)
+                    if report is None:
+                        await update.message.reply_text("⚠️ Профайлер не запущен")
+                    else:
+                        await update.message.reply_document(
+                            document=io.BytesIO(report.encode("utf-8")),
+                            filename="profile.collapsed.txt",
+                            caption="🔬 Профиль: сводка и стеки в collapsed-формате"
+                        )
+                else:
+                    await update.message.reply_text("❌ Формат: /profile start|stop")
+                return
+
+            if cmd == "tracemalloc":
+                action = args[0].lower() if args else ""
+                if action == "start":
+                    if tracemalloc.is_tracing():
+                        await update.message.reply_text("⚠️ tracemalloc уже запущен")
+                    else:
+                        start_tracemalloc()
+                        await update.message.reply_text("🧮 tracemalloc запущен, отчёт: /tracemalloc top")
+                elif action in ("top", "stop") and not tracemalloc.is_tracing():
+                    await update.message.reply_text("⚠️ tracemalloc не запущен, начните с /tracemalloc start")
+                elif action == "top":
+                    report = await asyncio.to_thread(tracemalloc_report)
+                    await update.message.reply_document(
+                        document=io.BytesIO(report.encode("utf-8")),
+                        filename="tracemalloc.txt",
+                        caption="🧮 Точки аллокаций"
+                    )
+                elif action == "stop":
+                    stop_tracemalloc()
+                    await update.message.reply_text("🧮 tracemalloc остановлен")
+                else:
+                    await update.message.reply_text("❌ Формат: /tracemalloc start|top|stop")
+                return
+
             if cmd == "dump_cache":
                 if NODE_NAME_CACHE:
-                    cache_lines = [f"{k}: {v}" for k, v in NODE_NAME_CACHE.items()]
+                    cache_lines = [f"{k}: {v}" for k, v in list(NODE_NAME_CACHE.items())]
                     reply = "Кэш имён:\n" + "\n".join(cache_lines)
                 else:
                     reply = "Кэш пуст"
@@ -645,7 +2312,7 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 today = time.strftime("%Y-%m-%d")
                 today_stats = []
-                for suffix, days in NODE_MESSAGE_HISTORY.items():
+                for suffix, days in list(NODE_MESSAGE_HISTORY.items()):
                     count = days.get(today, 0)
                     if count > 0:
                         today_stats.append(f"{NODE_NAME_CACHE.get(suffix, suffix)}: {count}")
@@ -686,6 +2353,16 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_parts.append("\n📈 Сообщения за сегодня:")
                     reply_parts.extend(today_stats)
 
+                reply_parts.append(
+                    f"\n📨 Доставка в mesh: подтверждено {MESSAGE_STATS['mesh_acked']}, "
+                    f"не доставлено {MESSAGE_STATS['mesh_failed']}, повторов {MESSAGE_STATS['mesh_retries']}"
+                )
+                if MESSAGE_STATS["mesh_parts"]:
+                    reply_parts.append(
+                        f"🧩 Длинные сообщения из mesh: {MESSAGE_STATS['mesh_parts']} частей "
+                        f"собрано в {MESSAGE_STATS['mesh_reassembled']}"
+                    )
+
                 await update.message.reply_text("\n".join(reply_parts))
                 return
 
@@ -742,37 +2419,16 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             if cmd == "direct":
-                direct_nodes = []
-                cutoff_snr = 0.0
-                now = time.time()
-
                 if not interface or not hasattr(interface, 'nodes'):
                     await update.message.reply_text("❌ Нет подключения к Meshtastic")
                     return
 
-                for node_id_str, node in interface.nodes.items():
-                    if node_id_str == interface.myInfo.my_node_num:
-                        continue
-
-                    if isinstance(node_id_str, str) and node_id_str.startswith('!'):
-                        try:
-                            num_id = int(node_id_str[1:], 16)
-                        except:
-                            continue
-                    else:
-                        num_id = node_id_str
-
-                    suffix = f"{num_id & 0xFFFFFF:06X}"
+                now = time.time()
+                direct_nodes = []
+                for suffix, snr, last_seen in direct_neighbors(now):
                     name = NODE_NAME_CACHE.get(suffix, suffix)
-                    last_heard = node.get('lastHeard', None)
-                    snr = node.get('snr')
-                    if snr is None:
-                        snr = -99.0
-
-                    if last_heard is not None and now - last_heard <= 300 and snr >= cutoff_snr:
-                        direct_nodes.append(f"{name} (SNR:{snr:.1f})")
-                    elif last_heard is None and snr >= cutoff_snr:
-                        direct_nodes.append(f"{name} (SNR:{snr:.1f}, время неизвестно)")
+                    snr_text = f"{snr:.1f}" if snr is not None else "?"
+                    direct_nodes.append(f"{name} (SNR:{snr_text}, {int(now - last_seen) // 60} мин назад)")
 
                 if not direct_nodes:
                     reply = "📡 Прямых соседей не обнаружено"
@@ -781,6 +2437,39 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(reply)
                 return
 
+            if cmd == "route" and args:
+                target = find_node_suffix(args[0])
+                if not target:
+                    await update.message.reply_text(f"❌ Нода '{args[0]}' не найдена в кэше")
+                    return
+                name = NODE_NAME_CACHE.get(target, target)
+                hops = hop_distance(target)
+                path = best_route(target)
+                lines = [f"🛰 Маршрут до {name} ({target}):"]
+                lines.append(f"Хопов: {hops if hops is not None else 'неизвестно'}")
+                if path and len(path) > 2:
+                    relay = NODE_NAME_CACHE.get(path[1], path[1])
+                    lines.append(f"Лучший ретранслятор: {relay}")
+                    lines.append("Путь: " + " → ".join(NODE_NAME_CACHE.get(n, n) for n in path))
+                elif path:
+                    lines.append("Прямой сосед")
+                else:
+                    lines.append("Путь в графе не найден")
+                await update.message.reply_text("\n".join(lines))
+                return
+
+            if cmd == "topology":
+                with TOPOLOGY_LOCK:
+                    edge_count = sum(len(n) for n in MESH_GRAPH.values()) // 2
+                    node_count = len(MESH_GRAPH)
+                document = io.BytesIO(export_topology_dot().encode("utf-8"))
+                await update.message.reply_document(
+                    document=document,
+                    filename="topology.dot",
+                    caption=f"🕸 Топология сети: {node_count} нод, {edge_count} связей"
+                )
+                return
+
             if cmd == "battery":
                 battery_info = []
                 if not interface or not hasattr(interface, 'nodes'):
@@ -824,16 +2513,22 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.exception("Ошибка в command_handler")
         await update.message.reply_text(f"💥 {e}")
+    finally:
+        record_timing("command_handler", started)
+
+def subscribe_meshtastic():
+    pub.subscribe(on_meshtastic_receive, "meshtastic.receive")
 
 async def connect_meshtastic():
     global interface
     while True:
         try:
-            logger.info("Подключение к Meshtastic через /dev/ttyACM0...")
-            interface = SerialInterface(devPath="/dev/ttyACM0")
+            logger.info(f"Подключение к Meshtastic через {MESH_DEVICE}...")
+            interface = SerialInterface(devPath=MESH_DEVICE)
             time.sleep(2)
-            pub.subscribe(on_meshtastic_message, "meshtastic.receive.text")
+            subscribe_meshtastic()
             update_node_name_cache()
+            sync_node_db()
             logger.info("✅ Подключено к Meshtastic")
             return
         except Exception as e:
@@ -842,10 +2537,271 @@ async def connect_meshtastic():
                 await application.bot.send_message(chat_id=ADMIN_USER_ID, text=f"❌ Ошибка подключения к Meshtastic: {e}\nПробую переподключиться через 30 секунд...")
             await asyncio.sleep(30)
 
+# ---------- Двухпроцессный режим (BRIDGE_MODE=split) ----------
+#
+# Радио-процесс владеет SerialInterface и пересылает пакеты по Unix-сокету,
+# процесс бота владеет Application и воспроизводит их в локальном pubsub.
+# Кадр: 4 байта длины + 1 байт типа (big-endian) + компактный JSON.
+
+def _strip_packet(obj):
+    """Убирает из пакета protobuf-объекты и сырые байты перед сериализацией"""
+    if isinstance(obj, dict):
+        return {k: _strip_packet(v) for k, v in obj.items() if k not in ("raw", "payload", "lastReceived")}
+    if isinstance(obj, (list, tuple)):
+        return [_strip_packet(v) for v in obj]
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.hex()
+    return obj
+
+def encode_frame(frame_type, payload):
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    return FRAME_HEADER.pack(len(body), frame_type) + body
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    length, frame_type = FRAME_HEADER.unpack(header)
+    if length > FRAME_MAX_SIZE:
+        raise ValueError(f"Слишком большой кадр: {length} байт")
+    body = await reader.readexactly(length)
+    return frame_type, json.loads(body)
+
+def _recv_exact(conn, size):
+    chunks = []
+    while size:
+        chunk = conn.recv(size)
+        if not chunk:
+            raise ConnectionError("Соединение закрыто")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def recv_frame(conn):
+    length, frame_type = FRAME_HEADER.unpack(_recv_exact(conn, FRAME_HEADER.size))
+    if length > FRAME_MAX_SIZE:
+        raise ValueError(f"Слишком большой кадр: {length} байт")
+    return frame_type, json.loads(_recv_exact(conn, length))
+
+def radio_send_frame(frame_type, payload):
+    """Отправка кадра процессу бота; пока бот не подключён, пакеты копятся в буфере"""
+    global RADIO_CONN
+    data = encode_frame(frame_type, payload)
+    with RADIO_SEND_LOCK:
+        if RADIO_CONN is None:
+            if frame_type == FRAME_PACKET:
+                RADIO_BACKLOG.append(data)
+            return
+        try:
+            RADIO_CONN.sendall(data)
+        except OSError as e:
+            logger.warning(f"⚠️ Процесс бота недоступен: {e}")
+            RADIO_CONN = None
+            if frame_type == FRAME_PACKET:
+                RADIO_BACKLOG.append(data)
+
+def radio_nodes_snapshot(iface):
+    my_node_num = iface.myInfo.my_node_num if getattr(iface, 'myInfo', None) else None
+    return {"nodes": _strip_packet(dict(iface.nodes or {})), "my_node_num": my_node_num}
+
+def radio_forward_packet(packet, interface, topic=pub.AUTO_TOPIC):
+    # Выполняется в потоке meshtastic: только сериализация и запись в сокет
+    try:
+        radio_send_frame(FRAME_PACKET, {"t": topic.getName(), "p": _strip_packet(packet)})
+    except Exception:
+        logger.exception("Ошибка пересылки пакета в процесс бота")
+
+def radio_on_connection_lost(interface, topic=pub.AUTO_TOPIC):
+    # Перезапуск радио-процесса выполнит супервизор
+    logger.critical("❌ Потеряна связь с Meshtastic, радио-процесс завершается")
+    os._exit(3)
+
+def radio_execute(iface, method, args, kwargs):
+    if method == "sendText":
+        packet = iface.sendText(*args, **kwargs)
+        return getattr(packet, "id", None)
+    if method == "sendPosition":
+        iface.sendPosition()
+        return None
+    if method == "reboot":
+        iface.localNode.reboot()
+        return None
+    if method == "resetNodeDb":
+        iface.localNode.resetNodeDb()
+        return None
+    if method == "writeConfig":
+        section = args[0]
+        for path, value in kwargs.get("sets", []):
+            keys = path.split(".")
+            obj = iface.localNode.localConfig
+            for key in keys[:-1]:
+                obj = getattr(obj, key)
+            setattr(obj, keys[-1], value)
+        iface.localNode.writeConfig(section)
+        return None
+    raise ValueError(f"Неизвестный метод: {method}")
+
+def radio_snapshot_loop(iface):
+    while True:
+        time.sleep(NODES_SNAPSHOT_INTERVAL)
+        try:
+            radio_send_frame(FRAME_NODES, radio_nodes_snapshot(iface))
+        except Exception as e:
+            logger.warning(f"Ошибка отправки базы нод: {e}")
+
+def run_radio_worker():
+    global RADIO_CONN
+    if os.path.exists(BRIDGE_SOCKET):
+        os.unlink(BRIDGE_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(BRIDGE_SOCKET)
+    server.listen(1)
+
+    try:
+        logger.info(f"Подключение к Meshtastic через {MESH_DEVICE}...")
+        iface = SerialInterface(devPath=MESH_DEVICE)
+    except Exception as e:
+        logger.critical(f"❌ Не удалось подключиться к Meshtastic: {e}")
+        sys.exit(1)
+    pub.subscribe(radio_forward_packet, "meshtastic.receive")
+    pub.subscribe(radio_on_connection_lost, "meshtastic.connection.lost")
+    threading.Thread(target=radio_snapshot_loop, args=(iface,), daemon=True).start()
+    logger.info(f"✅ Радио-процесс запущен, ожидание бота на {BRIDGE_SOCKET}")
+
+    while True:
+        conn, _ = server.accept()
+        logger.info("🔌 Процесс бота подключён")
+        with RADIO_SEND_LOCK:
+            try:
+                conn.sendall(encode_frame(FRAME_NODES, radio_nodes_snapshot(iface)))
+                while RADIO_BACKLOG:
+                    conn.sendall(RADIO_BACKLOG.popleft())
+                RADIO_CONN = conn
+            except OSError as e:
+                logger.warning(f"⚠️ Ошибка передачи буфера боту: {e}")
+                conn.close()
+                continue
+        try:
+            while True:
+                frame_type, payload = recv_frame(conn)
+                if frame_type != FRAME_CALL:
+                    continue
+                result = {"id": payload.get("id")}
+                try:
+                    result["r"] = radio_execute(iface, payload["m"], payload.get("a", []), payload.get("k", {}))
+                except Exception as e:
+                    logger.exception(f"Ошибка выполнения {payload.get('m')}")
+                    result["e"] = str(e)
+                radio_send_frame(FRAME_RESULT, result)
+        except (ConnectionError, OSError, ValueError) as e:
+            logger.warning(f"🔌 Процесс бота отключён: {e}")
+        finally:
+            with RADIO_SEND_LOCK:
+                if RADIO_CONN is conn:
+                    RADIO_CONN = None
+            conn.close()
+
+class RemoteConfig:
+    """Записывает присваивания вида prefs.bluetooth.enabled = True для передачи в радио-процесс"""
+
+    def __init__(self, ops, path=()):
+        object.__setattr__(self, "_ops", ops)
+        object.__setattr__(self, "_path", path)
+
+    def __getattr__(self, name):
+        return RemoteConfig(self._ops, self._path + (name,))
+
+    def __setattr__(self, name, value):
+        self._ops.append((".".join(self._path + (name,)), value))
+
+class RemoteNode:
+    def __init__(self, remote):
+        self._remote = remote
+        self._ops = []
+
+    @property
+    def localConfig(self):
+        return RemoteConfig(self._ops)
+
+    def writeConfig(self, section):
+        sets = [op for op in self._ops if op[0].split(".")[0] == section]
+        self._ops = [op for op in self._ops if op[0].split(".")[0] != section]
+        self._remote.call("writeConfig", section, sets=sets)
+
+    def reboot(self):
+        self._remote.call("reboot")
+
+    def resetNodeDb(self):
+        self._remote.call("resetNodeDb")
+
+class RemoteInterface:
+    """Заместитель SerialInterface в процессе бота: вызовы уходят в радио-процесс"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.nodes = {}
+        self.myInfo = None
+        self.localNode = RemoteNode(self)
+
+    def call(self, method, *args, **kwargs):
+        # id растут и между переподключениями: ключи ("call", id) в PENDING_ACKS
+        # от оборванной связи не должны совпасть с новыми
+        global REMOTE_CALL_ID
+        if self.writer.is_closing():
+            raise ConnectionError("Нет связи с радио-процессом")
+        REMOTE_CALL_ID += 1
+        self.writer.write(encode_frame(FRAME_CALL, {"id": REMOTE_CALL_ID, "m": method, "a": list(args), "k": kwargs}))
+        return REMOTE_CALL_ID
+
+    def sendText(self, text, **kwargs):
+        # id пакета станет известен из FRAME_RESULT радио-процесса
+        return SimpleNamespace(id=None, call_id=self.call("sendText", text, **kwargs))
+
+    def sendPosition(self):
+        return self.call("sendPosition")
+
+async def radio_link_task():
+    """Связь процесса бота с радио-процессом с автоматическим переподключением"""
+    global interface
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(BRIDGE_SOCKET)
+        except OSError as e:
+            logger.warning(f"Радио-процесс недоступен ({e}), повтор через 2 секунды")
+            await asyncio.sleep(2)
+            continue
+
+        remote = RemoteInterface(writer)
+        first_snapshot = True
+        logger.info("✅ Подключено к радио-процессу")
+        try:
+            while True:
+                frame_type, payload = await read_frame(reader)
+                if frame_type == FRAME_PACKET:
+                    pub.sendMessage(payload["t"], packet=payload["p"], interface=remote)
+                elif frame_type == FRAME_NODES:
+                    remote.nodes = payload["nodes"]
+                    remote.myInfo = SimpleNamespace(my_node_num=payload["my_node_num"])
+                    if first_snapshot:
+                        interface = remote
+                        update_node_name_cache()
+                        sync_node_db()
+                        first_snapshot = False
+                elif frame_type == FRAME_RESULT:
+                    if payload.get("e"):
+                        logger.warning(f"⚠️ Ошибка в радио-процессе (вызов {payload.get('id')}): {payload['e']}")
+                    bind_remote_packet_id(payload.get("id"), payload.get("r"), payload.get("e"))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logger.warning(f"🔌 Связь с радио-процессом потеряна: {e}")
+        finally:
+            if interface is remote:
+                interface = None
+            writer.close()
+        await asyncio.sleep(1)
+
 async def main():
-    global interface, application, CHANNEL_TO_CHAT, MAIN_LOOP, ADMIN_USER_ID
+    global interface, application, LEGACY_ROUTES, MAIN_LOOP, ADMIN_USER_ID, INBOUND_QUEUE
 
     MAIN_LOOP = asyncio.get_running_loop()
+    INBOUND_QUEUE = asyncio.Queue(maxsize=INBOUND_QUEUE_SIZE)
 
     BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     CHAT_ID_PUBLIC_RAW = os.getenv("CHAT_ID_PUBLIC")
@@ -854,28 +2810,28 @@ async def main():
     MESH_CHANNEL_PRIVATE_RAW = os.getenv("MESH_CHANNEL_PRIVATE")
     ADMIN_USER_ID_RAW = os.getenv("ADMIN_USER_ID")
 
-    if not all([BOT_TOKEN, CHAT_ID_PUBLIC_RAW, CHAT_ID_PRIVATE_RAW, 
-                MESH_CHANNEL_PUBLIC_RAW, MESH_CHANNEL_PRIVATE_RAW]):
+    if not BOT_TOKEN:
         logger.critical("❌ Отсутствуют обязательные переменные в .env")
         return
 
     try:
-        CHAT_ID_PUBLIC = int(CHAT_ID_PUBLIC_RAW)
-        CHAT_ID_PRIVATE = int(CHAT_ID_PRIVATE_RAW)
-        MESH_CHANNEL_PUBLIC = int(MESH_CHANNEL_PUBLIC_RAW)
-        MESH_CHANNEL_PRIVATE = int(MESH_CHANNEL_PRIVATE_RAW)
         ADMIN_USER_ID = int(ADMIN_USER_ID_RAW)
+        # Старый формат .env: ровно два маршрута, публичный и приватный
+        if all([CHAT_ID_PUBLIC_RAW, CHAT_ID_PRIVATE_RAW, MESH_CHANNEL_PUBLIC_RAW, MESH_CHANNEL_PRIVATE_RAW]):
+            LEGACY_ROUTES = [
+                {"channel": int(MESH_CHANNEL_PUBLIC_RAW), "chat_id": int(CHAT_ID_PUBLIC_RAW)},
+                {"channel": int(MESH_CHANNEL_PRIVATE_RAW), "chat_id": int(CHAT_ID_PRIVATE_RAW)},
+            ]
     except ValueError as e:
         logger.critical(f"❌ Некорректный формат ID: {e}")
         return
 
-    CHANNEL_TO_CHAT = {
-        MESH_CHANNEL_PUBLIC: CHAT_ID_PUBLIC,
-        MESH_CHANNEL_PRIVATE: CHAT_ID_PRIVATE
-    }
-    logger.info(f"✅ Загружены настройки каналов: {CHANNEL_TO_CHAT}")
+    if not load_routing_table():
+        logger.critical(f"❌ Нет маршрутов: создайте {ROUTES_FILE} или задайте каналы в .env")
+        return
 
     load_node_name_cache()
+    init_message_archive()
 
     application = Application.builder().token(BOT_TOKEN).build()
     
@@ -889,15 +2845,81 @@ async def main():
         command_handler
     ))
 
-    await connect_meshtastic()
+    asyncio.create_task(inbound_pipeline_task())
+    if BRIDGE_ROLE == "bot":
+        subscribe_meshtastic()
+        asyncio.create_task(radio_link_task())
+    else:
+        await connect_meshtastic()
     asyncio.create_task(auto_update_names())
     asyncio.create_task(monitor_meshtastic())
     asyncio.create_task(notify_new_nodes())
     asyncio.create_task(monitor_favorite_battery())
     asyncio.create_task(daily_reboot_task())
+    asyncio.create_task(topology_maintenance_task())
+    asyncio.create_task(watch_routes_task())
+    asyncio.create_task(ack_monitor_task())
+    asyncio.create_task(memory_maintenance_task())
+    asyncio.create_task(loop_lag_monitor())
+    asyncio.create_task(archive_flush_task())
 
     logger.info("✅ Telegram бот запущен. Ожидание сообщений...")
     await application.run_polling()
 
+def run_supervisor():
+    """Запускает радио-процесс и процесс бота и перезапускает каждый независимо"""
+    script = os.path.abspath(__file__)
+    procs = {}
+    failures = {"radio": 0, "bot": 0}
+    next_start = {"radio": 0.0, "bot": 0.0}
+    started_at = {}
+
+    def shutdown(signum, frame):
+        logger.info("🛑 Остановка супервизора")
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        now = time.monotonic()
+        for role in ("radio", "bot"):
+            proc = procs.get(role)
+            if proc is not None and proc.poll() is None:
+                continue
+            if proc is not None:
+                # Процесс, проработавший минуту, считается стабильным: сбрасываем backoff
+                if now - started_at[role] > 60:
+                    failures[role] = 0
+                failures[role] += 1
+                delay = min(60, 2 ** failures[role])
+                next_start[role] = now + delay
+                logger.warning(f"⚠️ Процесс {role} завершился с кодом {proc.returncode}, перезапуск через {delay} с")
+                procs.pop(role)
+                continue
+            if now >= next_start[role]:
+                procs[role] = subprocess.Popen([sys.executable, script, role])
+                started_at[role] = now
+                logger.info(f"▶️ Запущен процесс {role} (pid {procs[role].pid})")
+        time.sleep(1)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    role = sys.argv[1] if len(sys.argv) > 1 else None
+    if role == "radio":
+        BRIDGE_ROLE = "radio"
+        run_radio_worker()
+    elif role == "bot":
+        BRIDGE_ROLE = "bot"
+        asyncio.run(main())
+    elif BRIDGE_MODE == "split":
+        run_supervisor()
+    else:
+        asyncio.run(main())